@@ -0,0 +1,468 @@
+# rims_mcp_bench.py
+"""
+rims_mcp_server.pyのベンチマーク・負荷試験
+
+ローカルに偽のRIMS API(get_faq.php / get_rule.php / get_news.php / get_article.php / get_teams.php と
+合成PDF)を立ち上げ、MCPのstdioトランスポートでサーバーを起動して各ツールを並行に呼び出す。
+ツールごとにレイテンシ(p50/p99)、1秒あたりの呼び出し数、サーバーのCPU時間とRSSを表示する。
+また、サーバーを起動してから最初のlist_toolsの応答までの時間を複数回計測し、目標値(--startup-budget-ms)と比べる。
+
+例:
+    python rims_mcp_bench.py --calls 200 --clients 8 --pdf-pages 100
+    python rims_mcp_bench.py --tools get_faq,search --cold --output bench_output.txt
+    python rims_mcp_bench.py --startup-only --startup-runs 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from typing import Optional
+
+from aiohttp import web
+
+# MCPクライアントのインポート
+from mcp import ClientSession
+from mcp.client.stdio import stdio_client, StdioServerParameters
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rims_mcp_server.py")
+
+# 合成データに使う単語
+WORDS = (
+    "robot field zone ring seedling team match score point referee start retry penalty area "
+    "autonomous manual controller wireless battery weight size height safety emergency stop "
+    "judge time limit rule game stage pole box ball red blue"
+).split()
+
+
+def make_pdf(pages: list) -> bytes:
+    """
+    ページごとのテキスト(ASCIIのみ)から最小限のPDFを作る
+    """
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>")
+    font = 3 + 2 * len(pages)
+    for i, text in enumerate(pages):
+        lines = [line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for line in text.split("\n")]
+        stream = "BT /F1 9 Tf 36 806 Td 11 TL " + " ".join(f"({line}) '" for line in lines) + " ET"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {4 + 2 * i} 0 R "
+            f"/Resources << /Font << /F1 {font} 0 R >> >> >>"
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{obj}\nendobj\n".encode()
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def make_sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 14))]
+    return " ".join(words).capitalize() + "."
+
+
+def make_rule_pages(page_count: int, page_chars: int, seed: int) -> list:
+    """
+    見出し(「1.」「1.1」)と本文からなる合成ルールブックのページを作る
+    """
+    rng = random.Random(seed)
+    pages = []
+    for page_number in range(1, page_count + 1):
+        lines = []
+        if page_number % 4 == 1:
+            lines.append(f"{page_number // 4 + 1}. Section {page_number // 4 + 1}")
+        lines.append(f"{page_number // 4 + 1}.{page_number % 4 + 1} Topic {page_number}")
+        size = 0
+        while size < page_chars:
+            line = make_sentence(rng)
+            lines.append(line)
+            size += len(line)
+        pages.append("\n".join(lines))
+    return pages
+
+
+def make_fixtures(args) -> dict:
+    """
+    偽のRIMS APIが返すデータを作る
+    """
+    rng = random.Random(args.seed)
+    rule_pages = make_rule_pages(args.pdf_pages, args.pdf_page_chars, args.seed)
+    # 新しい版は一部のページの文を入れ替えたものにする(get_rule_diff用)
+    new_rule_pages = list(rule_pages)
+    for page_number in rng.sample(range(len(rule_pages)), max(1, len(rule_pages) // 10)):
+        new_rule_pages[page_number] += "\n" + make_sentence(rng)
+    pdfs = {
+        "rule_v1": make_pdf(rule_pages),
+        "rule_v2": make_pdf(new_rule_pages),
+        "article": make_pdf(make_rule_pages(2, args.pdf_page_chars, args.seed + 1)),
+    }
+    faq = [
+        {
+            "number": number,
+            "question": make_sentence(rng),
+            "answer": make_sentence(rng) + " " + make_sentence(rng),
+            "date": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        }
+        for number in range(1, args.faq_count + 1)
+    ]
+    news = [
+        {"article_id": str(article_id), "title": make_sentence(rng), "date": f"2025-03-{article_id % 28 + 1:02d}"}
+        for article_id in range(1, args.news_count + 1)
+    ]
+    articles = {
+        item["article_id"]: {
+            "article_title": item["title"],
+            "article": " ".join(make_sentence(rng) for _ in range(10)),
+            "date": item["date"],
+        }
+        for item in news
+    }
+    teams = [
+        {
+            "team_name": f"Team {number}",
+            "team_org": f"University {number % 20}",
+            "status": rng.choice([1, 2, 3, 4, 5]),
+            "data": None,
+            "match": None,
+        }
+        for number in range(1, args.team_count + 1)
+    ]
+    return {"pdfs": pdfs, "faq": faq, "news": news, "articles": articles, "teams": teams}
+
+
+async def start_fake_api(fixtures: dict, latency: float) -> tuple:
+    """
+    偽のRIMS APIを127.0.0.1の空いているポートで起動し、(runner, ベースURL, 呼び出し回数)を返す
+    """
+    hits = {}
+
+    async def api(request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        hits[name] = hits.get(name, 0) + 1
+        if latency:
+            await asyncio.sleep(latency)
+        origin = f"http://{request.host}"
+        if name == "get_faq.php":
+            query = request.query.get("query", "")
+            return web.json_response(
+                {"answered": [item for item in fixtures["faq"] if query.lower() in item["question"].lower()]}
+            )
+        if name == "get_rule.php":
+            return web.json_response({"rules": {
+                "name": "Benchmark Rules",
+                "abstract": "Synthetic rule book for benchmarking.",
+                "rule_books": [
+                    {"date": "2025-01-01", "url": f"{origin}/pdf/rule_v1"},
+                    {"date": "2025-03-01", "url": f"{origin}/pdf/rule_v2"},
+                ],
+                "field_books": [],
+                "other_documents": [],
+            }})
+        if name == "get_news.php":
+            return web.json_response({"news": fixtures["news"]})
+        if name == "get_article.php":
+            article_id = request.query.get("article_id", "")
+            article = fixtures["articles"].get(article_id)
+            if article is None:
+                return web.json_response({"error": "not found"}, status=404)
+            if article_id == "1":
+                article = {**article, "pdf_url": f"{origin}/pdf/article"}
+            return web.json_response(article)
+        if name == "get_teams.php":
+            return web.json_response({"teams": fixtures["teams"]})
+        return web.Response(status=404)
+
+    async def pdf(request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        hits[f"pdf/{name}"] = hits.get(f"pdf/{name}", 0) + 1
+        etag = f'"{name}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304)
+        return web.Response(body=fixtures["pdfs"][name], content_type="application/pdf", headers={"ETag": etag})
+
+    app = web.Application()
+    app.router.add_get("/api/v2/web/competition/{name}", api)
+    app.router.add_get("/pdf/{name}", pdf)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", hits
+
+
+def process_tree_usage() -> tuple:
+    """
+    このプロセスの子孫(サーバーとPDFワーカー)のCPU時間(秒)とRSS(バイト)の合計を返す
+    /procを読むためLinux以外では(None, None)を返す
+    """
+    if not os.path.isdir("/proc"):
+        return None, None
+    parents = {}
+    stats = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        pid = int(name)
+        parents[pid] = int(fields[1])
+        # utime, stime, rss (フィールド14, 15, 24)
+        stats[pid] = (int(fields[11]) + int(fields[12]), int(fields[21]))
+
+    descendants = set()
+    frontier = {os.getpid()}
+    while frontier:
+        frontier = {pid for pid, parent in parents.items() if parent in frontier and pid not in descendants}
+        descendants |= frontier
+    ticks = sum(stats[pid][0] for pid in descendants)
+    pages = sum(stats[pid][1] for pid in descendants)
+    return ticks / os.sysconf("SC_CLK_TCK"), pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def default_scenarios(args) -> list:
+    """
+    ベンチマークするツールと引数の一覧
+    """
+    article_ids = [str(article_id) for article_id in range(1, min(args.news_count, 10) + 1)]
+    return [
+        ("get_faq", {}),
+        ("get_faq_keyword", {"keyword": "robot"}),
+        ("get_rules", {}),
+        ("get_rule_pages", {"start_page": 1, "end_page": 3}),
+        ("get_rule_diff", {}),
+        ("get_rule_sections", {"query": "emergency stop", "top_k": 5}),
+        ("get_news_list", {}),
+        ("get_news_article", {"article_id": "1"}),
+        ("get_news_articles", {"article_ids": article_ids}),
+        ("get_team_list", {}),
+        ("get_team_changes", {"since": 0}),
+        ("search", {"query": "emergency stop"}),
+    ]
+
+
+async def call_once(session: ClientSession, tool: str, arguments: dict) -> tuple:
+    """
+    ツールを1回呼び出し、(経過秒, エラーかどうか)を返す
+    """
+    started = time.perf_counter()
+    try:
+        result = await session.call_tool(tool, arguments)
+        failed = bool(result.isError)
+        if not failed and result.content:
+            try:
+                failed = "error" in json.loads(result.content[0].text)
+            except (ValueError, TypeError, AttributeError):
+                pass
+    except Exception:
+        failed = True
+    return time.perf_counter() - started, failed
+
+
+async def bench_tool(session: ClientSession, tool: str, arguments: dict, calls: int, clients: int) -> dict:
+    """
+    clients個の並行クライアントで合計calls回ツールを呼び出し、結果を集計する
+    """
+    latencies = []
+    errors = 0
+    remaining = calls
+    peak_rss = 0
+    done = asyncio.Event()
+
+    async def sample_rss() -> None:
+        nonlocal peak_rss
+        while not done.is_set():
+            _, rss = process_tree_usage()
+            peak_rss = max(peak_rss, rss or 0)
+            try:
+                await asyncio.wait_for(done.wait(), 0.05)
+            except asyncio.TimeoutError:
+                pass
+
+    async def client() -> None:
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            elapsed, failed = await call_once(session, tool, arguments)
+            latencies.append(elapsed)
+            errors += failed
+
+    cpu_before, _ = process_tree_usage()
+    sampler = asyncio.create_task(sample_rss())
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    wall = time.perf_counter() - started
+    done.set()
+    await sampler
+    cpu_after, rss_after = process_tree_usage()
+    # 間引いて測っているため、最後の値も最大値に含める
+    peak_rss = max(peak_rss, rss_after or 0)
+
+    return {
+        "tool": tool,
+        "calls": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies, default=0) * 1000, 2),
+        "calls_per_sec": round(len(latencies) / wall, 1) if wall else 0.0,
+        "cpu_sec": round(cpu_after - cpu_before, 2) if cpu_before is not None else None,
+        "rss_mib": round(rss_after / 2 ** 20, 1) if rss_after is not None else None,
+        "peak_rss_mib": round(peak_rss / 2 ** 20, 1) if rss_after is not None else None,
+    }
+
+
+async def measure_startup(server_params: StdioServerParameters, errlog, runs: int) -> list:
+    """
+    サーバーを起動してから最初のlist_toolsの応答を受け取るまでの時間(秒)をruns回計測する
+    """
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        async with stdio_client(server_params, errlog=errlog) as (read_stream, write_stream):
+            async with ClientSession(read_stream, write_stream) as session:
+                await session.initialize()
+                await session.list_tools()
+                times.append(time.perf_counter() - started)
+    return times
+
+
+def format_table(results: list) -> str:
+    columns = ["tool", "calls", "errors", "p50_ms", "p99_ms", "max_ms", "calls_per_sec", "cpu_sec", "rss_mib", "peak_rss_mib"]
+    rows = [columns] + [["-" if result[column] is None else str(result[column]) for column in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    lines = ["  ".join(cell.ljust(widths[i]) if i == 0 else cell.rjust(widths[i]) for i, cell in enumerate(row)) for row in rows]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+async def bench_tools(server_params: StdioServerParameters, errlog, scenarios: list, selected: Optional[set], args) -> list:
+    """
+    1つのサーバーに対して、シナリオのツールを順に計測する
+    """
+    results = []
+    async with stdio_client(server_params, errlog=errlog) as (read_stream, write_stream):
+        async with ClientSession(read_stream, write_stream) as session:
+            await session.initialize()
+            tools_result = await session.list_tools()
+            available = {tool.name for tool in tools_result.tools}
+
+            for tool, arguments in scenarios:
+                if tool not in available or (selected and tool not in selected):
+                    continue
+                # 初回のPDF解析などは計測から除く
+                for _ in range(args.warmup):
+                    await call_once(session, tool, arguments)
+                result = await bench_tool(session, tool, arguments, args.calls, args.clients)
+                results.append(result)
+                print(f"{tool}: p50={result['p50_ms']}ms p99={result['p99_ms']}ms", file=sys.stderr)
+    return results
+
+
+async def run(args) -> int:
+    fixtures = make_fixtures(args)
+    runner, base_url, hits = await start_fake_api(fixtures, args.api_latency / 1000)
+    cache_dir = tempfile.TemporaryDirectory(prefix="rims-mcp-bench-")
+
+    env = dict(
+        os.environ,
+        API_ENDPOINT=base_url,
+        WEB_PAGE_URL=f"{base_url}/",
+        COMPETITION_ID="bench",
+        PDF_CACHE_DIR=cache_dir.name,
+    )
+    if args.cold:
+        # キャッシュを無効にして、毎回上流APIへ問い合わせる経路を計測する
+        for name in ("CACHE_TTL_FAQ", "CACHE_TTL_RULES", "CACHE_TTL_NEWS", "CACHE_TTL_ARTICLE", "CACHE_TTL_TEAMS", "CACHE_STALE_TTL"):
+            env[name] = "0"
+        env["PREFETCH_ENABLED"] = "false"
+    server_params = StdioServerParameters(command=sys.executable, args=[SERVER_SCRIPT], env=env)
+    errlog = sys.stderr if args.server_log else open(os.devnull, "w")
+
+    selected = set(args.tools.split(",")) if args.tools else None
+    results = []
+    try:
+        startup_times = await measure_startup(server_params, errlog, args.startup_runs)
+        if not args.startup_only:
+            results = await bench_tools(server_params, errlog, default_scenarios(args), selected, args)
+    finally:
+        await runner.cleanup()
+        cache_dir.cleanup()
+        if errlog is not sys.stderr:
+            errlog.close()
+
+    rule_pdf_kib = len(fixtures["pdfs"]["rule_v1"]) / 1024
+    startup_ms = percentile(startup_times, 0.5) * 1000 if startup_times else 0.0
+    over_budget = bool(startup_times) and startup_ms > args.startup_budget_ms
+    summary = [
+        f"startup (to first list_tools, {len(startup_times)} runs): median {startup_ms:.0f} ms, "
+        f"max {max(startup_times, default=0) * 1000:.0f} ms, budget {args.startup_budget_ms:.0f} ms"
+        + (" -- OVER BUDGET" if over_budget else ""),
+        f"calls per tool: {args.calls}, clients: {args.clients}, warmup: {args.warmup}, cold: {args.cold}",
+        f"rule book PDF: {args.pdf_pages} pages, {rule_pdf_kib:.0f} KiB; upstream latency: {args.api_latency} ms",
+        f"upstream requests: {json.dumps(hits, sort_keys=True)}",
+        "",
+        format_table(results),
+    ]
+    report = "\n".join(summary)
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+    return 1 if over_budget or any(result["errors"] for result in results) else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="rims_mcp_server.pyのベンチマーク・負荷試験")
+    parser.add_argument("--calls", type=int, default=100, help="ツールごとの呼び出し回数")
+    parser.add_argument("--clients", type=int, default=8, help="並行して呼び出すクライアント数")
+    parser.add_argument("--warmup", type=int, default=1, help="計測前に呼び出す回数")
+    parser.add_argument("--tools", help="計測するツール(カンマ区切り、省略時はすべて)")
+    parser.add_argument("--cold", action="store_true", help="サーバーのJSONキャッシュと先読みを無効にする")
+    parser.add_argument("--pdf-pages", type=int, default=50, help="合成ルールブックのページ数")
+    parser.add_argument("--pdf-page-chars", type=int, default=2000, help="合成ルールブックの1ページあたりの文字数")
+    parser.add_argument("--faq-count", type=int, default=200, help="合成FAQの件数")
+    parser.add_argument("--news-count", type=int, default=50, help="合成ニュースの件数")
+    parser.add_argument("--team-count", type=int, default=100, help="合成チームの件数")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="偽APIの応答遅延(ミリ秒)")
+    parser.add_argument("--seed", type=int, default=0, help="合成データの乱数シード")
+    parser.add_argument("--startup-runs", type=int, default=3, help="起動時間を計測する回数(0で計測しない)")
+    parser.add_argument("--startup-budget-ms", type=float, default=1500, help="起動時間(中央値)の目標値(ミリ秒)。超えた場合は終了コード1")
+    parser.add_argument("--startup-only", action="store_true", help="起動時間だけを計測する")
+    parser.add_argument("--output", help="結果の表を書き出すファイル")
+    parser.add_argument("--json", help="ツールごとの結果をJSON Linesで書き出すファイル")
+    parser.add_argument("--server-log", action="store_true", help="サーバーのログを標準エラー出力に表示する")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 # rims_mcp_client.py
 import asyncio
 import json
+import sys
+import time
+import argparse
 
 # MCPクライアントのインポート
 from mcp import ClientSession
@@ -9,9 +12,11 @@ from mcp.client.stdio import stdio_client, StdioServerParameters
 from dotenv import load_dotenv
 load_dotenv()
 
+# サーバーパラメータの設定
+SERVER_PARAMS = StdioServerParameters(command="python", args=["rims_mcp_server.py"])
+
 async def main():
-    # サーバーパラメータの設定
-    server_params = StdioServerParameters(command="python", args=["rims_mcp_server.py"])
+    server_params = SERVER_PARAMS
 
     # クライアントの初期化と実行
     try:
@@ -227,5 +232,110 @@ async def main():
         import traceback
         traceback.print_exc()
 
+def parse_calls(tokens: list) -> list:
+    """
+    コマンドラインの「ツール名 [JSON引数] ツール名 [JSON引数] ...」を呼び出しのリストにする
+    """
+    calls = []
+    for token in tokens:
+        if token.lstrip().startswith("{"):
+            if not calls or "arguments" in calls[-1]:
+                raise ValueError(f"引数の前にツール名がありません: {token}")
+            calls[-1]["arguments"] = json.loads(token)
+        else:
+            calls.append({"tool": token})
+    return [{"arguments": {}, **call} for call in calls]
+
+
+def read_batch(stream) -> list:
+    """
+    JSON Lines({"tool": ..., "arguments": {...}, "id": ...})の呼び出しを読み込む
+    """
+    calls = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        call = json.loads(line)
+        calls.append({"tool": call["tool"], "arguments": call.get("arguments", {}), "id": call.get("id")})
+    return calls
+
+
+async def call_tool(session: ClientSession, index: int, call: dict) -> dict:
+    """
+    ツールを1回呼び出し、結果と所要時間を1行分の辞書にして返す
+    """
+    started = time.perf_counter()
+    record = {"index": index, "tool": call["tool"], "arguments": call["arguments"]}
+    if call.get("id") is not None:
+        record["id"] = call["id"]
+    try:
+        result = await session.call_tool(call["tool"], call["arguments"])
+        texts = [content.text for content in result.content if hasattr(content, "text")]
+        try:
+            value = json.loads(texts[0]) if len(texts) == 1 else texts
+        except ValueError:
+            value = texts[0]
+        ok = not result.isError and not (isinstance(value, dict) and "error" in value)
+        record.update({"ok": ok, "result": value})
+    except Exception as e:
+        record.update({"ok": False, "error": str(e)})
+    record["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return record
+
+
+async def run_calls(calls: list, concurrency: int, list_tools: bool) -> int:
+    """
+    1つのセッションで複数のツール呼び出しを並行に実行し、終わったものから1行ずつJSONで出力する
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    failed = 0
+
+    async def run(index: int, call: dict) -> None:
+        nonlocal failed
+        async with semaphore:
+            record = await call_tool(session, index, call)
+        failed += not record["ok"]
+        print(json.dumps(record, ensure_ascii=False), flush=True)
+
+    started = time.perf_counter()
+    async with stdio_client(SERVER_PARAMS) as (read_stream, write_stream):
+        async with ClientSession(read_stream, write_stream) as session:
+            await session.initialize()
+            startup_ms = round((time.perf_counter() - started) * 1000, 1)
+            print(json.dumps({"event": "ready", "elapsed_ms": startup_ms}), file=sys.stderr, flush=True)
+            if list_tools:
+                tools_result = await session.list_tools()
+                for tool in tools_result.tools:
+                    print(json.dumps(
+                        {"tool": tool.name, "description": tool.description, "parameters": tool.inputSchema},
+                        ensure_ascii=False,
+                    ), flush=True)
+            await asyncio.gather(*(run(index, call) for index, call in enumerate(calls)))
+    return 1 if failed else 0
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(
+        description="RIMS MCPサーバーのクライアント(引数を指定しない場合は対話モード)",
+        epilog='例: python rims_mcp_client.py get_faq \'{"limit": 5}\' search \'{"query": "重量"}\'',
+    )
+    parser.add_argument("calls", nargs="*", help="ツール名と、続けてJSON形式の引数(省略可)")
+    parser.add_argument("--batch", action="store_true", help="標準入力からJSON Linesの呼び出しを読み込む")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に実行する呼び出し数")
+    parser.add_argument("--list", action="store_true", help="ツールの一覧をJSON Linesで出力する")
+    args = parser.parse_args()
+
+    if not args.calls and not args.batch and not args.list:
+        asyncio.run(main())
+        return
+    try:
+        calls = parse_calls(args.calls)
+        if args.batch:
+            calls += read_batch(sys.stdin)
+    except (ValueError, KeyError, TypeError) as e:
+        parser.error(f"呼び出しの指定が不正です: {e}")
+    sys.exit(asyncio.run(run_calls(calls, args.concurrency, args.list)))
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    cli()
\ No newline at end of file
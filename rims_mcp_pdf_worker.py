@@ -0,0 +1,98 @@
+"""
+PDF解析用のプロセスプールのワーカーで実行する関数
+
+rims_mcp_serverのプロセスプールから呼び出される。ワーカーの起動を軽くするため、
+このモジュールはサーバ本体(MCP・aiohttpなど)を読み込まず、pdfminerやTesseractも使うときに初めて読み込む。
+"""
+
+import io
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+from typing import Optional
+
+
+def init_worker(parent_pid: int) -> None:
+    """
+    ワーカーの標準出力をstderrに付け替え、親プロセスの終了を監視する
+    """
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    # 親プロセスが強制終了された場合でもワーカーが残らないようにする
+    def watch_parent() -> None:
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch_parent, daemon=True).start()
+
+
+def _status_kb(field: str) -> Optional[int]:
+    """
+    /proc/self/statusの項目(VmRSS・VmHWMなど)をKB単位で返す(読めない環境ではNone)
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    """
+    プロセスの最大常駐メモリ(VmHWM)を現在の値に戻す(Linuxのみ)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def extract_pdf_pages(data: bytearray) -> tuple:
+    """
+    PDFのバイト列からページごとのテキストを抽出する
+    (ページごとのテキスト, この解析で増えたワーカーの常駐メモリのピーク(KB))を返す
+    ピークは解析前の常駐メモリとの差で、測れない環境ではNoneになる。
+    """
+    # pdfminerは読み込みに時間がかかるため、ワーカーで初めて使うときに読み込む
+    from pdfminer.high_level import extract_pages
+    from pdfminer.layout import LTTextContainer
+
+    # ワーカーの最大常駐メモリはそれまでの解析すべての最大値なので、解析ごとに戻してから測る
+    measured = _reset_peak_rss()
+    rss_before_kb = _status_kb("VmRSS") if measured else None
+    pages = [
+        "".join(element.get_text() for element in page_layout if isinstance(element, LTTextContainer))
+        for page_layout in extract_pages(io.BytesIO(data))
+    ]
+    peak_rss_kb = _status_kb("VmHWM") if measured else None
+    if rss_before_kb is None or peak_rss_kb is None:
+        return pages, None
+    return pages, peak_rss_kb - rss_before_kb
+
+
+def ocr_pdf_page(pdf_path: str, page_number: int, dpi: int, lang: str) -> str:
+    """
+    PDFの1ページを画像にしてTesseractでOCRする
+    """
+    import pytesseract
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_root = os.path.join(temp_dir, "page")
+        subprocess.run(
+            ["pdftoppm", "-f", str(page_number), "-l", str(page_number), "-r", str(dpi), "-png", "-singlefile", pdf_path, image_root],
+            check=True,
+            capture_output=True,
+        )
+        with Image.open(f"{image_root}.png") as image:
+            return pytesseract.image_to_string(image, lang=lang)
@@ -1,11 +1,35 @@
 # rims_mcp_server.py
 from mcp.server.fastmcp import FastMCP
 import os
+import sys
+import time
+import asyncio
+import logging
+import functools
+import re
+import json
+import math
+import heapq
+import difflib
+import hashlib
+import gzip
+import random
+import unicodedata
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 import aiohttp
+import shutil
 import tempfile
-from PIL import Image
-from typing import Union
-from pdfminer.high_level import extract_text
+import multiprocessing
+from multiprocessing import resource_tracker
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import ModuleType
+from typing import AsyncIterator, Optional, Union
+from contextlib import asynccontextmanager, contextmanager
+
+import rims_mcp_pdf_worker as pdf_worker
 
 from dotenv import load_dotenv
 load_dotenv(override=False, verbose=False)
@@ -23,162 +47,769 @@ if not COMPETITION_ID:
 if not WEB_PAGE_URL:
     raise ValueError("WEB_PAGE_URL is not set in the .env file.")
 
+# ルール情報(ルールブック・フィールドブック・その他の資料)のAPI
+RULES_URL = f"{API_ENDPOINT}/api/v2/web/competition/get_rule.php?id={COMPETITION_ID}"
+
+# HTTP接続プールの設定(.envファイルまたは環境変数で上書き可能)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "10"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "180"))
+
+# PDFテキストキャッシュの設定(コンテナ再起動後も残す場合はこのディレクトリをボリュームにする)
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "rims-mcp")).strip()
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# PDFのダウンロード設定(最大サイズと受信単位)
+PDF_MAX_BYTES = int(os.getenv("PDF_MAX_BYTES", str(50 * 1024 * 1024)))
+PDF_CHUNK_SIZE = 64 * 1024
+# 取得済みのPDFが更新されていないかを確認する間隔(秒)。この間は条件付きGETも行わない
+PDF_REVALIDATE_INTERVAL = float(os.getenv("PDF_REVALIDATE_INTERVAL", "60"))
+
+# PDF解析用プロセスプールの設定
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(2, os.cpu_count() or 1))))
+PDF_QUEUE_MAX = int(os.getenv("PDF_QUEUE_MAX", "8"))
+PDF_JOB_TIMEOUT = float(os.getenv("PDF_JOB_TIMEOUT", "120"))
+
+# APIレスポンスのキャッシュ設定(秒)
+CACHE_TTL_FAQ = float(os.getenv("CACHE_TTL_FAQ", "300"))
+CACHE_TTL_RULES = float(os.getenv("CACHE_TTL_RULES", "600"))
+CACHE_TTL_NEWS = float(os.getenv("CACHE_TTL_NEWS", "300"))
+CACHE_TTL_ARTICLE = float(os.getenv("CACHE_TTL_ARTICLE", "3600"))
+CACHE_TTL_TEAMS = float(os.getenv("CACHE_TTL_TEAMS", "120"))
+CACHE_STALE_TTL = float(os.getenv("CACHE_STALE_TTL", "86400"))
+CACHE_SERVE_STALE_ON_ERROR = os.getenv("CACHE_SERVE_STALE_ON_ERROR", "true").strip().lower() in ("1", "true", "yes")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "256"))
+
+# get_news_articlesで同時に取得する記事数
+NEWS_BATCH_CONCURRENCY = int(os.getenv("NEWS_BATCH_CONCURRENCY", "4"))
+
+# テキストレイヤーのないページのOCR設定
+OCR_ENABLED = os.getenv("OCR_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+OCR_LANG = os.getenv("OCR_LANG", "jpn+eng").strip()
+
+# 全文検索インデックスを更新する間隔(秒)
+SEARCH_INDEX_TTL = float(os.getenv("SEARCH_INDEX_TTL", "600"))
+
+# チーム一覧のスナップショットを保存するSQLiteファイル(空の場合はメモリ上だけに持つ)と、保持する変更履歴の件数
+TEAM_DB_PATH = os.path.expanduser(os.getenv("TEAM_DB_PATH", "").strip())
+TEAM_CHANGES_MAX = int(os.getenv("TEAM_CHANGES_MAX", "1000"))
+
+# get_rule_sectionsで1つのチャンクに含める最大文字数
+SECTION_CHUNK_CHARS = int(os.getenv("SECTION_CHUNK_CHARS", "800"))
+
+# 起動時の先読みと定期更新の設定
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+PREFETCH_INTERVAL = float(os.getenv("PREFETCH_INTERVAL", "300"))
+PREFETCH_DELAY = float(os.getenv("PREFETCH_DELAY", "2"))
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+# 先読みのたびにsearchの検索インデックスも更新するか(ニュース記事の本文と添付PDFをすべて取得するため既定では行わない)
+PREFETCH_SEARCH_INDEX = os.getenv("PREFETCH_SEARCH_INDEX", "false").strip().lower() in ("1", "true", "yes")
+# 先読みのたびにget_rule_sectionsのインデックスも更新するか(フィールドブックなどすべての資料を取得・解析するため既定では行わない)
+PREFETCH_SECTION_INDEX = os.getenv("PREFETCH_SECTION_INDEX", "false").strip().lower() in ("1", "true", "yes")
+
+# MCPのトランスポート("stdio" / "sse" / "streamable-http")と、HTTPで待ち受けるアドレス
+MCP_TRANSPORT = os.getenv("MCP_TRANSPORT", "stdio").strip().lower()
+MCP_HOST = os.getenv("MCP_HOST", "127.0.0.1")
+MCP_PORT = int(os.getenv("MCP_PORT", "8000"))
+# 同時に実行するツール呼び出しの上限と、終了時に実行中の呼び出しを待つ時間(秒)
+MCP_MAX_CONCURRENCY = int(os.getenv("MCP_MAX_CONCURRENCY", "32"))
+MCP_SHUTDOWN_TIMEOUT = float(os.getenv("MCP_SHUTDOWN_TIMEOUT", "10"))
+
+# 上流API(RIMS)へのGETのリトライ回数と、指数バックオフの初期値・上限(秒)
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "8"))
+# ホストごとのリクエスト数の上限(1秒あたりの平均と、瞬間的に許す数。0で制限しない)
+UPSTREAM_RATE_LIMIT = float(os.getenv("UPSTREAM_RATE_LIMIT", "10"))
+UPSTREAM_RATE_BURST = int(os.getenv("UPSTREAM_RATE_BURST", "20"))
+# 連続してこの回数失敗したら、CIRCUIT_RESET_TIMEOUT秒の間は上流APIを呼ばずにキャッシュで応答する
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# 計測(ツール・上流APIのレイテンシなど)を有効にするか、計測値をJSON Linesで標準エラー出力に書くか
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+METRICS_LOG = os.getenv("METRICS_LOG", "false").strip().lower() in ("1", "true", "yes")
+
+# サーバプロセス全体で共有するHTTPセッション
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    共有HTTPセッションを返す(未作成または閉じられている場合は作成する)
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=HTTP_TOTAL_TIMEOUT,
+            sock_connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT,
+        )
+        _http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _http_session
+
+
+async def close_http_session() -> None:
+    """
+    共有HTTPセッションを閉じる
+    """
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+# lifespanを使用中のセッション数と、先読みタスク
+_lifespan_users = 0
+_prefetch_task: Optional[asyncio.Task] = None
+
+
+@asynccontextmanager
+async def lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """
+    サーバの起動時に共有リソースを作成し、終了時に解放する
+    HTTP/SSEでは接続(セッション)ごとにlifespanが呼ばれるため、使用数を数えて
+    最初の使用者が作成し、最後の使用者が解放する。
+    """
+    global _lifespan_users, _prefetch_task
+    _lifespan_users += 1
+    if _lifespan_users == 1:
+        get_http_session()
+        start_resource_tracker()
+        _prefetch_task = asyncio.create_task(prefetch_loop()) if PREFETCH_ENABLED else None
+    try:
+        yield
+    finally:
+        _lifespan_users -= 1
+        if _lifespan_users == 0:
+            prefetch_task, _prefetch_task = _prefetch_task, None
+            if prefetch_task is not None:
+                prefetch_task.cancel()
+                try:
+                    await prefetch_task
+                except asyncio.CancelledError:
+                    pass
+            await close_http_session()
+            shutdown_pdf_executor()
+
+
+# ツール呼び出しの同時実行数を制限するセマフォ
+_tool_semaphore = asyncio.Semaphore(MCP_MAX_CONCURRENCY)
+
+
+def limit_concurrency(func):
+    """
+    ツールの同時実行数をMCP_MAX_CONCURRENCYまでに制限するデコレータ
+    (上限を超えた呼び出しは空きが出るまで待つ)
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with _tool_semaphore:
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class Metrics:
+    """
+    カウンタとレイテンシのヒストグラム(Prometheus形式で出力できる)
+    値は(名前, ラベル)ごとに保持する。METRICS_ENABLEDがfalseの場合は何も記録しない。
+    """
+
+    # ヒストグラムのバケットの上限(秒)
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, enabled: bool, log: bool):
+        self.enabled = enabled
+        self.log = log
+        self.started_at = time.time()
+        # (名前, ラベル) -> 値
+        self.counters: dict = {}
+        # (名前, ラベル) -> [バケットごとの件数..., 件数, 合計, 最大]
+        self.histograms: dict = {}
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        if not self.enabled:
+            return
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, seconds: float, **fields) -> None:
+        """
+        レイテンシを記録する(fieldsは構造化ログにだけ出力する)
+        """
+        if not self.enabled:
+            return
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * len(self.BUCKETS) + [0, 0.0, 0.0]
+        for index, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram[index] += 1
+                break
+        histogram[-3] += 1
+        histogram[-2] += seconds
+        histogram[-1] = max(histogram[-1], seconds)
+        if self.log:
+            record = {"ts": round(time.time(), 3), "metric": name, **dict(labels), "ms": round(seconds * 1000, 2), **fields}
+            sys.stderr.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _quantile(self, histogram: list, q: float) -> Optional[float]:
+        """
+        バケットからq分位点(の上限)を推定する
+        """
+        count = histogram[-3]
+        if not count:
+            return None
+        target = q * count
+        cumulative = 0
+        for index, bound in enumerate(self.BUCKETS):
+            cumulative += histogram[index]
+            if cumulative >= target:
+                return min(bound, histogram[-1])
+        return histogram[-1]
+
+    def summary(self, name: str) -> dict:
+        """
+        指定した名前のヒストグラムを、ラベルの値ごとの件数・平均・p50/p99・最大(ミリ秒)にまとめる
+        """
+        result = {}
+        for (metric, labels), histogram in self.histograms.items():
+            if metric != name:
+                continue
+            count = histogram[-3]
+            result["/".join(str(value) for _, value in labels)] = {
+                "count": count,
+                "mean_ms": round(histogram[-2] / count * 1000, 2) if count else None,
+                "p50_ms": round(self._quantile(histogram, 0.5) * 1000, 2) if count else None,
+                "p99_ms": round(self._quantile(histogram, 0.99) * 1000, 2) if count else None,
+                "max_ms": round(histogram[-1] * 1000, 2),
+            }
+        return result
+
+    def counter_values(self, name: str) -> dict:
+        return {
+            "/".join(str(value) for _, value in labels): value
+            for (metric, labels), value in self.counters.items()
+            if metric == name
+        }
+
+    def prometheus(self, gauges: dict) -> str:
+        """
+        Prometheusのテキスト形式で出力する(gaugesは{名前: 値}で、そのまま出力する)
+        """
+        def format_labels(labels: tuple, extra: tuple = ()) -> str:
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{key}="{str(value).replace(chr(34), chr(39))}"' for key, value in items) + "}"
+
+        lines = []
+        for name in sorted({metric for metric, _ in self.counters}):
+            lines.append(f"# TYPE rims_mcp_{name} counter")
+            for (metric, labels), value in self.counters.items():
+                if metric == name:
+                    lines.append(f"rims_mcp_{name}{format_labels(labels)} {value}")
+        for name in sorted({metric for metric, _ in self.histograms}):
+            lines.append(f"# TYPE rims_mcp_{name}_seconds histogram")
+            for (metric, labels), histogram in self.histograms.items():
+                if metric != name:
+                    continue
+                cumulative = 0
+                for index, bound in enumerate(self.BUCKETS):
+                    cumulative += histogram[index]
+                    lines.append(f"rims_mcp_{name}_seconds_bucket{format_labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"rims_mcp_{name}_seconds_bucket{format_labels(labels, (('le', '+Inf'),))} {histogram[-3]}")
+                lines.append(f"rims_mcp_{name}_seconds_sum{format_labels(labels)} {histogram[-2]:.6f}")
+                lines.append(f"rims_mcp_{name}_seconds_count{format_labels(labels)} {histogram[-3]}")
+        for name, value in gauges.items():
+            lines.append(f"# TYPE rims_mcp_{name} gauge")
+            lines.append(f"rims_mcp_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(METRICS_ENABLED, METRICS_LOG)
+
+
+def instrument(func):
+    """
+    ツールの所要時間とエラー数を記録するデコレータ(計測が無効な場合は何もしない)
+    """
+    if not METRICS_ENABLED:
+        return func
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        labels = (("tool", func.__name__),)
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = await func(*args, **kwargs)
+            ok = not (isinstance(result, dict) and "error" in result)
+            return result
+        finally:
+            metrics.observe("tool_latency", labels, time.perf_counter() - started, ok=ok)
+            if not ok:
+                metrics.inc("tool_errors_total", labels)
+    return wrapper
+
+
+def _endpoint_name(url: str) -> str:
+    """
+    URLから計測用のエンドポイント名(get_faq.phpなど)を取り出す
+    """
+    return url.split("?", 1)[0].rsplit("/", 1)[-1]
+
+
+logger = logging.getLogger("rims_mcp")
+
 # FastMCPを使用してサーバを作成
-mcp = FastMCP(title="RIMS-MCP", description="RIMSのMCPサーバ", api_endpoint=API_ENDPOINT, competition_id=COMPETITION_ID)
+mcp = FastMCP(title="RIMS-MCP", description="RIMSのMCPサーバ", api_endpoint=API_ENDPOINT, competition_id=COMPETITION_ID, lifespan=lifespan, host=MCP_HOST, port=MCP_PORT)
 
 # MCPツールとしてget_faqを定義
 @mcp.tool()
-async def get_faq():
+@instrument
+@limit_concurrency
+async def get_faq(
+    limit: Optional[int] = None,
+    offset: int = 0,
+    fields: Optional[list[str]] = None,
+    number_from: Optional[int] = None,
+    number_to: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+):
     """
     FAQを取得するツール（全件）
+    limit/offsetで件数と開始位置を、fieldsで返す項目("number", "question", "answer", "date",
+    "question_image", "answer_image")を指定できる。
+    number_from/number_toでFAQ番号の範囲を、date_from/date_to(例: "2025-04-01")で日付の範囲を絞り込める。
     """
     url = f"{API_ENDPOINT}/api/v2/web/competition/get_faq.php?id={COMPETITION_ID}&query="
-    headers = {"Referer": WEB_PAGE_URL}  # "Referer" is the correct HTTP header name
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                # FAQデータを整形して返す
-                return {
-                    "faq": [
-                        {
-                            "number": item.get("number"),
-                            "question": item.get("question", ""),
-                            "answer": item.get("answer", ""),
-                            "question_image": item.get("question_image"),
-                            "answer_image": item.get("answer_image"),
-                        }
-                        for item in data.get("answered", [])
-                    ]
-                }
-            else:
-                return {"error": f"Failed to fetch FAQ. Status code: {response.status}"}
+    status, data, cache_age = await fetch_json(url, CACHE_TTL_FAQ)
+    if data is not None:
+        # FAQデータを整形して返す
+        faq = [
+            {
+                "number": item.get("number"),
+                "question": item.get("question", ""),
+                "answer": item.get("answer", ""),
+                "date": item.get("date"),
+                "question_image": item.get("question_image"),
+                "answer_image": item.get("answer_image"),
+            }
+            for item in data.get("answered", [])
+        ]
+        # 番号・日付(日単位)で絞り込む
+        faq = [
+            item for item in faq
+            if in_range(item["number"], number_from, number_to)
+            and in_range(item["date"][:10] if item["date"] else None, date_from, date_to)
+        ]
+        return {**paginate("faq", faq, limit, offset, fields), "cache_age": cache_age}
+    else:
+        return {"error": f"Failed to fetch FAQ. Status code: {status}"}
+
+
+def in_range(value, lower, upper) -> bool:
+    """
+    valueがlower以上upper以下か(lower/upperがNoneの場合はその側を制限しない)
+    """
+    if lower is None and upper is None:
+        return True
+    if value is None:
+        return False
+    try:
+        return (lower is None or value >= lower) and (upper is None or value <= upper)
+    except TypeError:
+        return False
+
+
+def latest_rule_book(rules: dict) -> Optional[dict]:
+    """
+    get_rule.phpのrulesから、日付が最も新しいルールブックを返す
+    """
+    return max(rules.get("rule_books", []), key=lambda x: x.get("date", ""), default=None)
 
 
+def paginate(key: str, items: list, limit: Optional[int], offset: int, fields: Optional[list[str]]) -> dict:
+    """
+    一覧をoffset/limitで切り出し、fieldsで指定した項目だけに絞って返す
+    """
+    offset = max(offset, 0)
+    end = len(items) if limit is None else offset + max(limit, 0)
+    page = items[offset:end]
+    if fields:
+        page = [{field: item[field] for field in fields if field in item} for item in page]
+    return {
+        key: page,
+        "total": len(items),
+        "offset": offset,
+        "next_offset": end if end < len(items) else None,
+    }
+
 
 @mcp.tool()
+@instrument
+@limit_concurrency
 async def get_faq_keyword(keyword: str):
     """
     FAQを取得するツール（キーワード検索）
     """
     url = f"{API_ENDPOINT}/api/v2/web/competition/get_faq.php?id={COMPETITION_ID}&query={keyword}"
-    headers = {"Referer": WEB_PAGE_URL}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                # FAQデータを整形して返す
-                return {
-                    "faq": [
-                        {
-                            "number": item.get("number"),
-                            "question": item.get("question", ""),
-                            "answer": item.get("answer", ""),
-                            "question_image": item.get("question_image"),
-                            "answer_image": item.get("answer_image"),
-                        }
-                        for item in data.get("answered", [])
-                    ]
+    status, data, cache_age = await fetch_json(url, CACHE_TTL_FAQ)
+    if data is not None:
+        # FAQデータを整形して返す
+        return {
+            "faq": [
+                {
+                    "number": item.get("number"),
+                    "question": item.get("question", ""),
+                    "answer": item.get("answer", ""),
+                    "question_image": item.get("question_image"),
+                    "answer_image": item.get("answer_image"),
                 }
-            else:
-                return {"error": f"Failed to fetch FAQ. Status code: {response.status}"}
+                for item in data.get("answered", [])
+            ],
+            "cache_age": cache_age,
+        }
+    else:
+        return {"error": f"Failed to fetch FAQ. Status code: {status}"}
 
 
 @mcp.tool()
+@instrument
+@limit_concurrency
 async def get_rules():
     """
     ルールブックの最新版を取得するツール
     """
     # リファラを偽装してAPIからルールブックを取得する処理を実装(WEB_PAGE_URLにリファラを指定)
-    # /api/v2/web/competition/get_rule.php?id={COMPETITION_ID}
-    url = f"{API_ENDPOINT}/api/v2/web/competition/get_rule.php?id={COMPETITION_ID}"
-    headers = {"Referer": WEB_PAGE_URL}  # "Referer" is the correct HTTP header name
+    status, data, cache_age = await fetch_json(RULES_URL, CACHE_TTL_RULES)
+    if data is not None:
+        # 最新のルールブックのみを取得
+        rule_book = latest_rule_book(data.get("rules", {}))
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-
-                # 最新のルールブックのみを取得
-                latest_rule_book = max(
-                    data.get("rules", {}).get("rule_books", []),
-                    key=lambda x: x.get("date", ""),
-                    default=None
-                )
+        # latest_rule_bookのURLを取得
+        if rule_book:
+            latest_rule_book_url = rule_book.get("url", "")
+        else:
+            latest_rule_book_url = None
 
-                # latest_rule_bookのURLを取得
-                if latest_rule_book:
-                    latest_rule_book_url = latest_rule_book.get("url", "")
-                else:
-                    latest_rule_book_url = None
-
-                if latest_rule_book_url:
-                    # PDFのURLを受け取り、OCRを実行してテキストを返すツール
-                    ocr_text = await pdf_ocr(latest_rule_book_url)
-                else:
-                    ocr_text = "No rule book available."
-
-                rules = {
-                    "name": data.get("rules", {}).get("name", "No name provided."),
-                    "abstract": data.get("rules", {}).get("abstract", "No abstract provided."),
-                    "rule": ocr_text,
-                    "latest_rule_book": latest_rule_book,
-                    "field_books": data.get("rules", {}).get("field_books", []),
-                    "other_documents": data.get("rules", {}).get("other_documents", [])
-                }
+        if latest_rule_book_url:
+            # PDFのURLを受け取り、OCRを実行してテキストを返すツール
+            ocr_text = await pdf_ocr(latest_rule_book_url)
+        else:
+            ocr_text = "No rule book available."
+
+        rules = {
+            "name": data.get("rules", {}).get("name", "No name provided."),
+            "abstract": data.get("rules", {}).get("abstract", "No abstract provided."),
+            "rule": ocr_text,
+            "latest_rule_book": rule_book,
+            "field_books": data.get("rules", {}).get("field_books", []),
+            "other_documents": data.get("rules", {}).get("other_documents", [])
+        }
+
+        return {"rules": rules, "cache_age": cache_age}
+    else:
+        return {"error": f"Failed to fetch rules. Status code: {status}"}
+
+@mcp.tool()
+@instrument
+@limit_concurrency
+async def get_rule_pages(start_page: int = 1, end_page: Optional[int] = None, section: Optional[str] = None):
+    """
+    ルールブックの最新版から指定したページ(または節)だけを取得するツール
+    start_page〜end_page(1始まり、両端を含む)のテキストと、総ページ数・目次を返す。
+    end_pageを省略した場合はstart_pageの1ページのみを返す。
+    sectionを指定した場合は、目次の見出しに一致する節のページを返す(例: "3.2", "競技フィールド")。
+    """
+    status, data, cache_age = await fetch_json(RULES_URL, CACHE_TTL_RULES)
+    if data is None:
+        return {"error": f"Failed to fetch rules. Status code: {status}"}
+
+    rule_book = latest_rule_book(data.get("rules", {}))
+    if not rule_book or not rule_book.get("url"):
+        return {"error": "No rule book available."}
+    rule_book_url = rule_book["url"]
+
+    if section:
+        # まず目次だけを取得し、節の範囲を決める
+        result = await pdf_pages(rule_book_url, 1, 0)
+        if "error" in result:
+            return result
+        page_range = find_section_pages(result["toc"], section, result["page_count"])
+        if page_range is None:
+            return {"error": f"Section not found: {section}", "toc": result["toc"]}
+        start_page, end_page = page_range
+    elif end_page is None:
+        end_page = start_page
+
+    result = await pdf_pages(rule_book_url, start_page, end_page)
+    if "error" in result:
+        return result
+
+    return {
+        "rules": {
+            "name": data.get("rules", {}).get("name", "No name provided."),
+            "latest_rule_book": rule_book,
+            **result,
+        },
+        "cache_age": cache_age,
+    }
+
+
+def _heading_number(title: str) -> Optional[str]:
+    """
+    見出しの番号(「第1章」「3.2」など、全角は半角にそろえる)を返す。見出しでなければNone
+    """
+    match = TOC_HEADING_PATTERN.match(title)
+    if not match:
+        return None
+    return unicodedata.normalize("NFKC", match.group(1))
+
+
+def _heading_level(title: str) -> int:
+    """
+    見出しの階層(「第1章」は0、「1.」は1、「1.2」は2 ...)を返す
+    """
+    number = _heading_number(title)
+    if number is None or number.startswith("第"):
+        return 0
+    return number.count(".") + 1
+
+
+def find_section_pages(toc: list, section: str, page_count: int) -> Optional[tuple]:
+    """
+    目次からsectionの節を探し、その節のページ範囲(開始, 終了)を返す
+    見出しの番号との完全一致、番号の前方一致(「3」に対する「3.1」「3.2」)、見出しの部分一致の順に探す。
+    """
+    keyword = unicodedata.normalize("NFKC", section).strip().rstrip(".")
+    numbers = [_heading_number(entry["title"]) for entry in toc]
+
+    number = keyword
+    index = next((index for index, heading_number in enumerate(numbers) if heading_number == keyword), None)
+    if index is None:
+        # 「3」の見出しがなければ「3.1」「3.2」...をまとめて1つの節とする
+        index = next(
+            (index for index, heading_number in enumerate(numbers) if heading_number and heading_number.startswith(keyword + ".")),
+            None,
+        )
+    if index is None:
+        keyword = keyword.lower()
+        index = next(
+            (index for index, entry in enumerate(toc) if keyword in unicodedata.normalize("NFKC", entry["title"]).lower()),
+            None,
+        )
+        if index is None:
+            return None
+        number = numbers[index]
+
+    if number.startswith("第"):
+        # 「第1章」などは、同じか上位の階層の次の見出しまでを節の範囲とする
+        level = _heading_level(toc[index]["title"])
+        return _section_range(toc, index, page_count, lambda i: _heading_level(toc[i]["title"]) > level)
+    # 番号が続く見出し(「2」に対する「2.1」)までを節の範囲とする
+    # (上位の見出しが目次から漏れていても、後ろの節を含めないように番号で判定する)
+    return _section_range(toc, index, page_count, lambda i: bool(numbers[i]) and numbers[i].startswith(number + "."))
+
+
+def _section_range(toc: list, index: int, page_count: int, inside) -> tuple:
+    """
+    toc[index]から、inside(i)がFalseになる最初の見出しまでのページ範囲を返す
+    """
+    start_page = toc[index]["page"]
+    for following in range(index + 1, len(toc)):
+        if not inside(following):
+            return start_page, max(toc[following]["page"], start_page)
+    return start_page, page_count
+
+
+@mcp.tool()
+@instrument
+@limit_concurrency
+async def get_rule_diff(old_date: Optional[str] = None, new_date: Optional[str] = None):
+    """
+    ルールブックの2つの版の差分を節ごとに取得するツール
+    old_date / new_dateにはルールブックの日付(前方一致、例: "2025-03")を指定する。
+    両方省略した場合は最新版とその1つ前の版を、片方だけ指定した場合はその版と隣の版を比較する。
+    変更された節ごとに、追加・削除・変更された文だけを返す。
+    """
+    status, data, cache_age = await fetch_json(RULES_URL, CACHE_TTL_RULES)
+    if data is None:
+        return {"error": f"Failed to fetch rules. Status code: {status}"}
+
+    rule_books = sorted(
+        (rule_book for rule_book in data.get("rules", {}).get("rule_books", []) if rule_book.get("url")),
+        key=lambda x: x.get("date", ""),
+        reverse=True,
+    )
+    versions = [rule_book.get("date", "") for rule_book in rule_books]
+
+    def find_index(date: Optional[str]) -> Optional[int]:
+        if date is None:
+            return None
+        return next((index for index, version in enumerate(versions) if version.startswith(date)), None)
+
+    # rule_booksは新しい順なので、1つ前の版は添字が1つ大きい
+    new_index, old_index = find_index(new_date), find_index(old_date)
+    if (new_date is not None and new_index is None) or (old_date is not None and old_index is None):
+        return {"error": "Rule book version not found.", "versions": versions}
+    if new_index is None and old_index is None:
+        new_index, old_index = 0, 1
+    elif old_index is None:
+        # 新しい版だけ指定された場合は、その1つ前の版と比べる
+        old_index = new_index + 1
+    elif new_index is None:
+        # 古い版だけ指定された場合は、その1つ後の版と比べる
+        if old_index == 0:
+            return {"error": "No newer rule book version to compare with.", "versions": versions}
+        new_index = old_index - 1
+    if old_index >= len(rule_books):
+        return {"error": "No older rule book version to compare with.", "versions": versions}
+    if old_index == new_index:
+        return {"error": "old_date and new_date refer to the same rule book version.", "versions": versions}
+    if old_index < new_index:
+        return {"error": "old_date must be older than new_date.", "versions": versions}
+    new_rule_book, old_rule_book = rule_books[new_index], rule_books[old_index]
+
+    result = await rule_book_diff(old_rule_book["url"], new_rule_book["url"])
+    if "error" in result:
+        return result
+
+    return {
+        "old_rule_book": old_rule_book,
+        "new_rule_book": new_rule_book,
+        **result,
+        "cache_age": cache_age,
+    }
+
+
+@mcp.tool()
+@instrument
+@limit_concurrency
+async def get_rule_sections(query: str, top_k: int = 5):
+    """
+    ルールブック(最新版)・フィールドブック・その他の資料から、質問に関係する箇所だけを取得するツール
+    資料を見出しごとの短いチャンクに分け、queryに近い順にtop_k件を資料名・見出し・ページ番号付きで返す。
+    ルールに関する質問では、get_rulesで全文を取得する代わりにこのツールを使う。
+    """
+    if not await section_index_refresher.ensure():
+        return {"error": "Failed to fetch rules."}
+
+    return {
+        "sections": section_index.search(query, top_k=top_k, full_text=True),
+        "indexed_chunks": len(section_index),
+        "index_age": section_index_refresher.age(),
+    }
 
-                return {"rules": rules}
-            else:
-                return {"error": f"Failed to fetch rules. Status code: {response.status}"}
 
 @mcp.tool()
+@instrument
+@limit_concurrency
 async def get_news_list():
     """
     ニュース一覧を取得するツール(/api/v2/web/competition/get_news.php?id={COMPETITION_ID})
     """
     url = f"{API_ENDPOINT}/api/v2/web/competition/get_news.php?id={COMPETITION_ID}"
-    headers = {"Referer": WEB_PAGE_URL}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                return {"news": data.get("news", [])}
-            else:
-                return {"error": f"Failed to fetch news. Status code: {response.status}"}
+    status, data, cache_age = await fetch_json(url, CACHE_TTL_NEWS)
+    if data is not None:
+        return {"news": data.get("news", []), "cache_age": cache_age}
+    else:
+        return {"error": f"Failed to fetch news. Status code: {status}"}
 
 @mcp.tool()
+@instrument
+@limit_concurrency
 async def get_news_article(article_id: str):
     """
     ニュース記事を取得するツール(/api/v2/web/competition/get_article.php?id={COMPETITION_ID}&article_id={article_id})
     """
+    return await fetch_news_article(article_id)
+
+
+@mcp.tool()
+@instrument
+@limit_concurrency
+async def get_news_articles(article_ids: list[str]):
+    """
+    複数のニュース記事をまとめて取得するツール
+    記事は並行して取得し、取得に失敗した記事はその記事の"error"として返す(他の記事の結果は返す)。
+    """
+    semaphore = asyncio.Semaphore(NEWS_BATCH_CONCURRENCY)
+
+    async def fetch(article_id: str) -> dict:
+        async with semaphore:
+            try:
+                result = await fetch_news_article(article_id)
+            except Exception as e:
+                result = {"error": f"Failed to fetch news article: {str(e)}"}
+        return {"article_id": article_id, **result}
+
+    # 同じ記事IDの重複は1回だけ取得する
+    unique_ids = list(dict.fromkeys(str(article_id) for article_id in article_ids))
+    articles = await asyncio.gather(*(fetch(article_id) for article_id in unique_ids))
+    return {
+        "articles": articles,
+        "errors": sum(1 for article in articles if "error" in article),
+    }
+
+
+async def fetch_news_article(article_id: str) -> dict:
+    """
+    ニュース記事を取得し、PDFが添付されていればそのテキストも含めて返す
+    """
     url = f"{API_ENDPOINT}/api/v2/web/competition/get_article.php?id={COMPETITION_ID}&article_id={article_id}"
-    headers = {"Referer": WEB_PAGE_URL}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                # PDF URLが存在する場合はOCRも実行
-                pdf_url = data.get("pdf_url")
-                ocr_text = None
-                if pdf_url:
-                    ocr_text = await pdf_ocr(pdf_url)
-                return {
-                    "news": {
-                        "title": data.get("article_title", data.get("title", "")),
-                        "content": data.get("article", data.get("content", "")),
-                        "date": data.get("date", ""),
-                        "image": data.get("image", ""),
-                        "pdf_url": pdf_url,
-                        "ocr_text": ocr_text
-                    }
-                }
-            else:
-                return {"error": f"Failed to fetch news article. Status code: {response.status}"}
+    status, data, cache_age = await fetch_json(url, CACHE_TTL_ARTICLE)
+    if data is not None:
+        # PDF URLが存在する場合はOCRも実行
+        pdf_url = data.get("pdf_url")
+        ocr_text = None
+        if pdf_url:
+            ocr_text = await pdf_ocr(pdf_url)
+        return {
+            "news": {
+                "title": data.get("article_title", data.get("title", "")),
+                "content": data.get("article", data.get("content", "")),
+                "date": data.get("date", ""),
+                "image": data.get("image", ""),
+                "pdf_url": pdf_url,
+                "ocr_text": ocr_text
+            },
+            "cache_age": cache_age,
+        }
+    else:
+        return {"error": f"Failed to fetch news article. Status code: {status}"}
 
 @mcp.tool()
-async def get_team_list():
+@instrument
+@limit_concurrency
+async def get_team_list(
+    limit: Optional[int] = None,
+    offset: int = 0,
+    fields: Optional[list[str]] = None,
+    status: Optional[list[int]] = None,
+    org: Optional[str] = None,
+    name: Optional[str] = None,
+):
     """
     チーム一覧を取得するツール(/api/v2/web/competition/get_team.php?id={COMPETITION_ID})
+    limit/offsetで件数と開始位置を、fieldsで返す項目(例: ["team_name", "team_org", "status_label"])を指定できる。
+    statusでチーム状態のコード、orgで所属、nameでチーム名(いずれも完全一致、なければ部分一致)を絞り込める。
+    応答の"version"をget_team_changesに渡すと、それ以降の変更だけを取得できる。
     チーム状態(status)は以下の通り:
         0: 状態非公開
         1: エントリー済み
@@ -194,87 +825,2005 @@ async def get_team_list():
         11: エキシビジョン参加
         12: 不明
     """
-    TEAM_STATUS_MAP = {
-        0: "状態非公開",
-        1: "エントリー済み",
-        2: "書類審査通過",
-        3: "ビデオ審査通過",
-        4: "大会出場",
-        5: "出場辞退",
-        6: "出場取り消し",
-        7: "出場取りやめ",
-        8: "書類審査落選",
-        9: "ビデオ審査落選",
-        10: "審査中",
-        11: "エキシビジョン参加",
-        12: "不明"
+    fetch_status, data, cache_age = await refresh_team_store(CACHE_TTL_TEAMS)
+    if data is not None:
+        teams = team_store.find(name=name, org=org, status=status)
+        return {**paginate("teams", teams, limit, offset, fields), "version": team_store.version, "cache_age": cache_age}
+    else:
+        return {"error": f"Failed to fetch team list. Status code: {fetch_status}"}
+
+
+@mcp.tool()
+@instrument
+@limit_concurrency
+async def get_team_changes(since: Optional[Union[int, str]] = None, limit: int = 100):
+    """
+    チームの状態の変化と試合結果(match)の更新だけを取得するツール
+    sinceには前回の応答の"version"(整数)か、日時(ISO 8601形式、例: "2025-08-20T10:00:00+09:00")を指定する。
+    指定したversion・日時より後の変更を古い順に返す。sinceを省略した場合は直近の変更を返す。
+    応答の"reset"がtrueの場合は、変更履歴が残っていないため、get_team_listで一覧を取得し直す。
+    limitは1以上を指定する。
+    """
+    if limit < 1:
+        return {"error": f"Invalid limit: {limit}. Use 1 or more."}
+    fetch_status, data, cache_age = await refresh_team_store(CACHE_TTL_TEAMS)
+    if data is None and team_store.version == 0:
+        return {"error": f"Failed to fetch team list. Status code: {fetch_status}"}
+    try:
+        changes, reset = team_store.changes_since(since)
+    except ValueError:
+        return {"error": f"Invalid since: {since}. Use a version number or an ISO 8601 timestamp."}
+    version = team_store.version
+    if since is None:
+        changes = changes[-limit:]
+        has_more = False
+    else:
+        has_more = len(changes) > limit
+        if has_more:
+            # 同じversionの変更が次のページにまたがらないよう、versionの境目で区切る
+            cut = limit
+            while cut > 0 and changes[cut - 1]["version"] == changes[limit]["version"]:
+                cut -= 1
+            if cut == 0:
+                cut = limit
+                while cut < len(changes) and changes[cut]["version"] == changes[limit - 1]["version"]:
+                    cut += 1
+            has_more = cut < len(changes)
+            changes = changes[:cut]
+            version = changes[-1]["version"]
+    return {
+        "version": version,
+        "changes": changes,
+        "has_more": has_more,
+        "reset": reset,
+        "cache_age": cache_age,
     }
-    url = f"{API_ENDPOINT}/api/v2/web/competition/get_teams.php?id={COMPETITION_ID}"
-    headers = {"Referer": WEB_PAGE_URL}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                teams = []
-                for team in data.get("teams", []):
-                    status_code = team.get("status")
-                    status_label = TEAM_STATUS_MAP.get(status_code, "不明")
-                    teams.append({
-                        "team_name": team.get("team_name", ""),
-                        "team_org": team.get("team_org", ""),
-                        "team_icon": team.get("team_icon"),
-                        "team_homepage": team.get("team_homepage"),
-                        "team_twitter": team.get("team_twitter"),
-                        "team_facebook": team.get("team_facebook"),
-                        "team_instagram": team.get("team_instagram"),
-                        "team_tiktok": team.get("team_tiktok"),
-                        "team_bluesky": team.get("team_bluesky"),
-                        "status_label": status_label,
-                        "data": team.get("data"),
-                        "match": team.get("match"),
-                    })
-                return {"teams": teams}
-            else:
-                return {"error": f"Failed to fetch team list. Status code: {response.status}"}
 
 
+@mcp.tool()
+@instrument
+@limit_concurrency
+async def search(query: str, sources: Optional[list[str]] = None, top_k: int = 10):
+    """
+    FAQ・ニュース・ルールブックを横断して全文検索するツール
+    sourcesで検索対象を絞り込める("faq", "news", "rules")。
+    初回のみインデックスを作成するためにAPIを呼び出し、以降はローカルのインデックスだけで検索する。
+    """
+    if not await search_index_refresher.ensure():
+        return {"error": "Failed to fetch FAQ, news and rules for the search index."}
+
+    prefixes = [f"{source}:" for source in sources] if sources else None
+    return {
+        "results": search_index.search(query, top_k=top_k, prefixes=prefixes),
+        "indexed_documents": len(search_index),
+        "index_age": search_index_refresher.age(),
+    }
+
 
-# PDFのURLを受け取り、OCRを実行してテキストを返すツール
-async def pdf_ocr(url: str) -> Union[str, dict]:
+@mcp.tool()
+@instrument
+@limit_concurrency
+async def get_server_stats(format: str = "json"):
     """
-    PDFのURLを受け取り、OCRを実行してテキストを返すツール
+    サーバの計測値を取得するツール
+    ツール・上流APIごとのレイテンシ(件数・平均・p50/p99・最大)、上流APIのステータスコード別の件数と受信バイト数、
+    PDFの解析時間とページ数、キャッシュのヒット率を返す。
+    format="prometheus"を指定するとPrometheusのテキスト形式で返す。
     """
-    headers = {"Referer": WEB_PAGE_URL}
+    if format == "prometheus":
+        return server_stats_prometheus()
+    json_cache_stats = json_cache.stats()
+    pdf_cache_stats = pdf_text_cache.stats()
+    return {
+        "uptime": round(time.time() - metrics.started_at, 1),
+        "metrics_enabled": metrics.enabled,
+        "active_sessions": _lifespan_users,
+        "tools": metrics.summary("tool_latency"),
+        "tool_errors": metrics.counter_values("tool_errors_total"),
+        "upstream": {
+            "latency": metrics.summary("upstream_latency"),
+            "json_decode": metrics.summary("json_decode"),
+            "responses": metrics.counter_values("upstream_responses_total"),
+            "bytes": metrics.counter_values("upstream_bytes_total"),
+            "retries": metrics.counter_values("upstream_retries_total"),
+            "short_circuits": metrics.counter_values("upstream_short_circuits_total"),
+            "hosts": {
+                host: {"circuit": breaker.state, "consecutive_failures": breaker.failures, "tokens": round(bucket.tokens, 1)}
+                for host, (bucket, breaker) in _upstream_hosts.items()
+            },
+        },
+        "pdf": {
+            "parse": metrics.summary("pdf_parse").get("", {}),
+            "pages": metrics.counter_values("pdf_pages_total").get("", 0),
+            "ocr_pages": metrics.counter_values("pdf_ocr_pages_total").get("", 0),
+            "recent": dict(pdf_metrics),
+        },
+        "json_cache": {
+            **json_cache_stats,
+            "hit_rate": hit_rate(json_cache_stats["hits"] + json_cache_stats["stale_hits"], json_cache_stats["misses"]),
+        },
+        "pdf_text_cache": {
+            **pdf_cache_stats,
+            "hit_rate": hit_rate(pdf_cache_stats["hits"], pdf_cache_stats["misses"]),
+        },
+        "search_index": {"documents": len(search_index)},
+    }
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    return {"error": f"Failed to fetch PDF. Status code: {response.status}"}
 
-                data = await response.read()
+def hit_rate(hits: int, misses: int) -> Optional[float]:
+    total = hits + misses
+    return round(hits / total, 4) if total else None
 
-    except aiohttp.ClientError as e:
-        return {"error": f"HTTP request failed: {str(e)}"}
 
-    # 一時ファイルへの保存とOCR処理
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            temp_file.write(data)
-            temp_file_path = temp_file.name
+def server_stats_prometheus() -> str:
+    """
+    計測値とキャッシュの状態をPrometheusのテキスト形式で返す
+    """
+    json_cache_stats = json_cache.stats()
+    pdf_cache_stats = pdf_text_cache.stats()
+    gauges = {
+        "uptime_seconds": round(time.time() - metrics.started_at, 1),
+        "active_sessions": _lifespan_users,
+        "json_cache_hits": json_cache_stats["hits"],
+        "json_cache_stale_hits": json_cache_stats["stale_hits"],
+        "json_cache_misses": json_cache_stats["misses"],
+        "json_cache_entries": json_cache_stats["entries"],
+        "pdf_text_cache_hits": pdf_cache_stats["hits"],
+        "pdf_text_cache_misses": pdf_cache_stats["misses"],
+        "pdf_text_cache_revalidated": pdf_cache_stats["revalidated"],
+        "pdf_text_cache_entries": pdf_cache_stats["entries"],
+        "pdf_text_cache_bytes": pdf_cache_stats["bytes"],
+        "search_index_documents": len(search_index),
+    }
+    return metrics.prometheus(gauges)
+
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics_endpoint(request):
+    """
+    HTTP/SSEで実行している場合に、Prometheusから計測値を取得するためのエンドポイント
+    """
+    from starlette.responses import PlainTextResponse
+
+    return PlainTextResponse(server_stats_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+class UpstreamUnavailable(Exception):
+    """
+    サーキットブレーカーが開いているため、上流APIを呼ばなかった場合の例外
+    """
+
 
+class TokenBucket:
+    """
+    トークンバケットによるレート制限(1秒あたりrate個、最大burst個まで貯まる)
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        # 待つ順番を守るため、トークンを待つ間もロックを保持する
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """
+    連続した失敗がthreshold回に達したら開き、reset_timeout秒の間は呼び出しを止める
+    その後は1回だけ試し(half-open)、成功すれば閉じ、失敗すればまた開く。
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.trial_at is not None else "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None or self.threshold <= 0:
+            return True
+        now = time.monotonic()
+        # 試行中の呼び出しが中断された場合に備え、一定時間たてば次の試行を許す
+        if now - (self.trial_at or self.opened_at) >= self.reset_timeout:
+            self.trial_at = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.trial_at is not None or (self.threshold > 0 and self.failures >= self.threshold):
+            if self.opened_at is None:
+                logger.warning("Upstream circuit opened after %s consecutive failures.", self.failures)
+            self.opened_at = time.monotonic()
+            self.trial_at = None
+
+
+# ホストごとのレート制限とサーキットブレーカー(ホスト -> (TokenBucket, CircuitBreaker))
+_upstream_hosts: dict = {}
+
+# リトライする(サーバ側の一時的な問題とみなす)ステータスコード
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+def _upstream_host(host: str) -> tuple:
+    limits = _upstream_hosts.get(host)
+    if limits is None:
+        limits = _upstream_hosts[host] = (
+            TokenBucket(UPSTREAM_RATE_LIMIT, UPSTREAM_RATE_BURST),
+            CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+        )
+    return limits
+
+
+async def upstream_get(url: str, attempt) -> tuple:
+    """
+    上流APIへのGETを、レート制限・サーキットブレーカー・リトライを通して実行する
+    attempt(session)は1回分のリクエストを行い、(ステータスコード, 結果)を返すコルーチン関数。
+    通信エラーやRETRY_STATUSESの場合は、ジッター付きの指数バックオフで最大UPSTREAM_RETRIES回やり直す。
+    サーキットブレーカーが開いている場合はUpstreamUnavailableを送出する。
+    """
+    host = urlsplit(url).netloc
+    bucket, breaker = _upstream_host(host)
+    if not breaker.allow():
+        metrics.inc("upstream_short_circuits_total", (("endpoint", _endpoint_name(url)),))
+        raise UpstreamUnavailable(f"Upstream {host} is unavailable (circuit open).")
+
+    for attempt_number in range(UPSTREAM_RETRIES + 1):
+        await bucket.acquire()
+        error = None
         try:
-            ocr_text = extract_text(temp_file_path)
-        except Exception as e:
-            return {"error": f"PDF text extraction failed: {str(e)}"}
-        finally:
-            os.unlink(temp_file_path)
+            status, result = await attempt(get_http_session())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e
+        else:
+            if status not in RETRY_STATUSES:
+                breaker.record_success()
+                return status, result
+        breaker.record_failure()
+        if attempt_number == UPSTREAM_RETRIES or not breaker.allow():
+            break
+        # ジッター付きの指数バックオフ(full jitter)
+        delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt_number))
+        metrics.inc("upstream_retries_total", (("endpoint", _endpoint_name(url)),))
+        await asyncio.sleep(delay)
 
-        return ocr_text
+    if error is not None:
+        raise error
+    return status, result
+
+
+async def request_json(url: str) -> tuple:
+    """
+    APIからJSONを取得し、(ステータスコード, データ)を返す
+    200以外の場合データはNone、通信に失敗した場合はステータスコードもNoneになる
+    """
+    labels = (("endpoint", _endpoint_name(url)),)
+
+    async def attempt(session: aiohttp.ClientSession) -> tuple:
+        started = time.perf_counter()
+        async with session.get(url, headers={"Referer": WEB_PAGE_URL}) as response:
+            metrics.inc("upstream_responses_total", labels + (("status", response.status),))
+            if response.status != 200:
+                return response.status, None
+            body = await response.read()
+        metrics.inc("upstream_bytes_total", labels, len(body))
+        metrics.observe("upstream_latency", labels, time.perf_counter() - started, status=response.status, bytes=len(body))
+        return response.status, body
+
+    try:
+        status, body = await upstream_get(url, attempt)
+    except UpstreamUnavailable:
+        return None, None
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        metrics.inc("upstream_responses_total", labels + (("status", "error"),))
+        return None, None
+    if body is None:
+        return status, None
+
+    decode_started = time.perf_counter()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None, None
+    metrics.observe("json_decode", labels, time.perf_counter() - decode_started)
+    return status, data
+
+
+class JsonCache:
+    """
+    APIのJSONレスポンスのキャッシュ(stale-while-revalidate)
+    TTL内はキャッシュを返し、TTLを過ぎてもstale_ttl内であれば古いデータを返しつつ裏で取得し直す。
+    同じURLへの同時の取得は1回にまとめ、保持する件数はmax_entriesまでとする(LRU)。
+    """
+
+    def __init__(self, max_entries: int, stale_ttl: float, serve_stale_on_error: bool):
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.serve_stale_on_error = serve_stale_on_error
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        # url -> {"data", "fetched_at"}
+        self._entries: OrderedDict = OrderedDict()
+        # url -> 取得中のタスク
+        self._inflight: dict = {}
+
+    async def get(self, url: str, ttl: float) -> tuple:
+        """
+        (ステータスコード, データ, キャッシュの経過秒数)を返す(取得できなかった場合データはNone)
+        ttlが0以下の場合は常に取得し直す
+        """
+        entry = self._entries.get(url)
+        if entry is not None and ttl > 0:
+            age = time.monotonic() - entry["fetched_at"]
+            if age < ttl:
+                self.hits += 1
+                self._entries.move_to_end(url)
+                return 200, entry["data"], round(age, 1)
+            if age < ttl + self.stale_ttl:
+                # 古いデータを返し、裏で取得し直す
+                self.stale_hits += 1
+                self._entries.move_to_end(url)
+                self._fetch(url)
+                return 200, entry["data"], round(age, 1)
+
+        self.misses += 1
+        status, data = await asyncio.shield(self._fetch(url))
+        if data is not None:
+            return status, data, 0.0
+        entry = self._entries.get(url)
+        if entry is not None and self.serve_stale_on_error:
+            # 取得に失敗した場合は古いデータで代用する
+            self.stale_hits += 1
+            return 200, entry["data"], round(time.monotonic() - entry["fetched_at"], 1)
+        return status, None, None
+
+    def _fetch(self, url: str) -> asyncio.Task:
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.create_task(self._fetch_and_store(url))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return task
+
+    async def _fetch_and_store(self, url: str) -> tuple:
+        status, data = await request_json(url)
+        if data is not None:
+            self._entries[url] = {"data": data, "fetched_at": time.monotonic()}
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return status, data
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+        }
+
+
+json_cache = JsonCache(CACHE_MAX_ENTRIES, CACHE_STALE_TTL, CACHE_SERVE_STALE_ON_ERROR)
+
+
+async def fetch_json(url: str, ttl: float) -> tuple:
+    """
+    キャッシュを通してAPIからJSONを取得し、(ステータスコード, データ, キャッシュの経過秒数)を返す
+    """
+    return await json_cache.get(url, ttl)
+
+
+# チーム状態のコードと表示名
+TEAM_STATUS_MAP = {
+    0: "状態非公開",
+    1: "エントリー済み",
+    2: "書類審査通過",
+    3: "ビデオ審査通過",
+    4: "大会出場",
+    5: "出場辞退",
+    6: "出場取り消し",
+    7: "出場取りやめ",
+    8: "書類審査落選",
+    9: "ビデオ審査落選",
+    10: "審査中",
+    11: "エキシビジョン参加",
+    12: "不明"
+}
+
+
+def shape_team(team: dict) -> dict:
+    """
+    get_teams.phpのチームを、ツールで返す形に整形する
+    """
+    status_code = team.get("status")
+    return {
+        "team_name": team.get("team_name", ""),
+        "team_org": team.get("team_org", ""),
+        "team_icon": team.get("team_icon"),
+        "team_homepage": team.get("team_homepage"),
+        "team_twitter": team.get("team_twitter"),
+        "team_facebook": team.get("team_facebook"),
+        "team_instagram": team.get("team_instagram"),
+        "team_tiktok": team.get("team_tiktok"),
+        "team_bluesky": team.get("team_bluesky"),
+        "status": status_code,
+        "status_label": TEAM_STATUS_MAP.get(status_code, "不明"),
+        "data": team.get("data"),
+        "match": team.get("match"),
+    }
+
+
+def _normalize_key(text: Optional[str]) -> str:
+    return unicodedata.normalize("NFKC", text or "").strip().lower()
+
+
+class TeamStore:
+    """
+    チーム一覧のスナップショットと変更履歴
+    取得したチーム一覧を前回と比べ、状態(status)の変化・試合結果(match)の更新・チームの追加と削除を
+    変更履歴に記録する。変更があるたびにversionを1つ上げる。
+    チーム名・所属の索引を持ち、db_pathを指定した場合はSQLiteに保存して再起動後も履歴を引き継ぐ。
+    """
+
+    def __init__(self, db_path: str, max_changes: int):
+        self.db_path = db_path
+        self.version = 0
+        # キー -> 整形済みのチーム(APIの並び順)
+        self._teams: dict = {}
+        # 正規化したチーム名 / 所属 -> キーの集合
+        self._by_name: dict = {}
+        self._by_org: dict = {}
+        self._changes: deque = deque(maxlen=max_changes)
+        # 履歴から押し出された変更のうち最も新しいversion
+        self._dropped_version = 0
+        self._last_source = None
+        self._lock = asyncio.Lock()
+        self._db = None
+        self._loaded = False
+
+    @staticmethod
+    def _key(team: dict) -> str:
+        team_id = team.get("team_id", team.get("id"))
+        if team_id is not None:
+            return str(team_id)
+        return f"{team.get('team_org') or ''}\t{team.get('team_name') or ''}"
+
+    def _index(self) -> None:
+        self._by_name = {}
+        self._by_org = {}
+        for key, team in self._teams.items():
+            self._by_name.setdefault(_normalize_key(team["team_name"]), set()).add(key)
+            self._by_org.setdefault(_normalize_key(team["team_org"]), set()).add(key)
+
+    def _open_db(self):
+        import sqlite3
+
+        if self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS teams (
+                    key TEXT PRIMARY KEY, position INTEGER, team_name TEXT, team_org TEXT, status INTEGER, record TEXT
+                );
+                CREATE INDEX IF NOT EXISTS teams_name ON teams (team_name);
+                CREATE INDEX IF NOT EXISTS teams_org ON teams (team_org);
+                CREATE TABLE IF NOT EXISTS team_changes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, version INTEGER, time TEXT, change TEXT
+                );
+                CREATE INDEX IF NOT EXISTS team_changes_version ON team_changes (version);
+                CREATE TABLE IF NOT EXISTS team_meta (name TEXT PRIMARY KEY, value INTEGER);
+                """
+            )
+        return self._db
+
+    def _load(self) -> None:
+        """
+        SQLiteに保存したスナップショットと変更履歴を読み込む
+        """
+        self._loaded = True
+        if not self.db_path:
+            return
+        try:
+            db = self._open_db()
+            meta = dict(db.execute("SELECT name, value FROM team_meta"))
+            rows = db.execute("SELECT key, record FROM teams ORDER BY position").fetchall()
+            changes = db.execute(
+                "SELECT change FROM team_changes ORDER BY id DESC LIMIT ?", (self._changes.maxlen,)
+            ).fetchall()
+        except Exception:
+            logger.exception("Failed to load team snapshot from %s", self.db_path)
+            return
+        self.version = meta.get("version", 0)
+        self._dropped_version = meta.get("dropped_version", 0)
+        self._teams = {key: json.loads(record) for key, record in rows}
+        self._changes.extend(json.loads(change) for change, in reversed(changes))
+        self._index()
+
+    def _save(self, changes: list) -> None:
+        """
+        スナップショットと新しい変更をSQLiteに保存する(スレッドで実行される)
+        """
+        db = self._open_db()
+        with db:
+            db.execute("DELETE FROM teams")
+            db.executemany(
+                "INSERT INTO teams (key, position, team_name, team_org, status, record) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (key, position, team["team_name"], team["team_org"], team["status"], json.dumps(team, ensure_ascii=False))
+                    for position, (key, team) in enumerate(self._teams.items())
+                ],
+            )
+            db.executemany(
+                "INSERT INTO team_changes (version, time, change) VALUES (?, ?, ?)",
+                [(change["version"], change["time"], json.dumps(change, ensure_ascii=False)) for change in changes],
+            )
+            db.execute(
+                "DELETE FROM team_changes WHERE id <= (SELECT MAX(id) FROM team_changes) - ?", (self._changes.maxlen,)
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO team_meta (name, value) VALUES (?, ?)",
+                [("version", self.version), ("dropped_version", self._dropped_version)],
+            )
+
+    async def update(self, teams: list) -> None:
+        """
+        取得したチーム一覧でスナップショットを更新し、変更を履歴に記録する
+        """
+        # JSONキャッシュから同じ一覧が返された場合は比較しない
+        if teams is self._last_source:
+            return
+        async with self._lock:
+            if not self._loaded:
+                self._load()
+            if teams is self._last_source:
+                return
+            current = {}
+            for team in teams:
+                current[self._key(team)] = shape_team(team)
+
+            # 最初のスナップショット(履歴がない状態)では、すべてのチームを追加として記録しない
+            first = self.version == 0 and not self._teams
+            changes = [] if first else self._diff(self._teams, current)
+            self._teams = current
+            self._last_source = teams
+            self._index()
+            if not changes and not first:
+                return
+
+            self.version += 1
+            now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            for change in changes:
+                change.update({"version": self.version, "time": now})
+                if len(self._changes) == self._changes.maxlen:
+                    self._dropped_version = self._changes[0]["version"]
+                self._changes.append(change)
+            if changes:
+                logger.info("Team snapshot version %s: %s changes", self.version, len(changes))
+            if self.db_path:
+                try:
+                    await asyncio.to_thread(self._save, changes)
+                except Exception:
+                    logger.exception("Failed to save team snapshot to %s", self.db_path)
+
+    @staticmethod
+    def _diff(previous: dict, current: dict) -> list:
+        changes = []
+        for key, team in current.items():
+            old = previous.get(key)
+            base = {"team_name": team["team_name"], "team_org": team["team_org"]}
+            if old is None:
+                changes.append({**base, "type": "added", "status": team["status"], "status_label": team["status_label"]})
+                continue
+            if old["status"] != team["status"]:
+                changes.append({
+                    **base,
+                    "type": "status",
+                    "old_status": old["status"],
+                    "old_status_label": old["status_label"],
+                    "status": team["status"],
+                    "status_label": team["status_label"],
+                })
+            if old["match"] != team["match"]:
+                changes.append({**base, "type": "match", "match": team["match"]})
+        for key, old in previous.items():
+            if key not in current:
+                changes.append({"team_name": old["team_name"], "team_org": old["team_org"], "type": "removed"})
+        return changes
+
+    def changes_since(self, since: Union[int, str, None]) -> tuple:
+        """
+        sinceより後の変更と、履歴が欠けているかどうか(欠けている場合はTrue)を返す
+        sinceはversion(整数)かISO 8601形式の日時。日時が不正な場合はValueErrorを送出する
+        """
+        if not self._loaded:
+            self._load()
+        if since is None:
+            return list(self._changes), False
+        if isinstance(since, int) or (isinstance(since, str) and since.strip().isdigit()):
+            version = int(since)
+            return [change for change in self._changes if change["version"] > version], version < self._dropped_version
+        since_time = datetime.fromisoformat(since.strip().replace("Z", "+00:00"))
+        if since_time.tzinfo is None:
+            since_time = since_time.astimezone()
+        changes = [change for change in self._changes if datetime.fromisoformat(change["time"]) > since_time]
+        reset = bool(self._dropped_version) and (not self._changes or datetime.fromisoformat(self._changes[0]["time"]) > since_time)
+        return changes, reset
+
+    def find(self, name: Optional[str] = None, org: Optional[str] = None, status: Optional[list] = None) -> list:
+        """
+        チーム名・所属(索引で完全一致、なければ部分一致)とチーム状態で絞り込んだチームを返す
+        """
+        keys = None
+        for value, index in ((name, self._by_name), (org, self._by_org)):
+            if not value:
+                continue
+            value = _normalize_key(value)
+            matched = index.get(value)
+            if matched is None:
+                matched = set().union(*(index[text] for text in index if value in text))
+            keys = matched if keys is None else keys & matched
+        if keys is None:
+            teams = list(self._teams.values())
+        else:
+            teams = [team for key, team in self._teams.items() if key in keys]
+        if status:
+            teams = [team for team in teams if team["status"] in status]
+        return teams
+
+
+team_store = TeamStore(TEAM_DB_PATH, TEAM_CHANGES_MAX)
+
+
+async def refresh_team_store(ttl: float) -> tuple:
+    """
+    チーム一覧を取得してスナップショットを更新し、(ステータスコード, データ, キャッシュの経過秒数)を返す
+    """
+    url = f"{API_ENDPOINT}/api/v2/web/competition/get_teams.php?id={COMPETITION_ID}"
+    status, data, cache_age = await fetch_json(url, ttl)
+    if data is not None:
+        await team_store.update(data.get("teams", []))
+    return status, data, cache_age
+
+
+class PdfTextCache:
+    """
+    PDFから抽出したテキストのキャッシュ
+    URL(+ETag/Last-Modified)とPDF本体のSHA-256の両方で引くことができ、ディスクに永続化する。
+    テキストはページ区切り(\\f)で連結して1ファイルに保存し、各ページの開始位置(バイト)を
+    インデックスに持つことで、指定したページだけを読み出せるようにしている。
+    合計サイズがmax_bytesを超えた場合は最も古く使われたものから削除する(LRU)。
+    """
+
+    INDEX_FILE = "index.json"
+    PAGE_SEPARATOR = "\f"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        # url -> {"etag", "last_modified", "sha256"}
+        self._urls: dict = {}
+        # sha256 -> {"size", "offsets", "toc"}(先頭が最も古く使われたもの)
+        self._entries: OrderedDict = OrderedDict()
+        self._total_bytes = 0
+        self._load()
+
+    def _path(self, sha256: str) -> str:
+        return os.path.join(self.directory, f"{sha256}.txt")
+
+    def _load(self) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, self.INDEX_FILE), encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        for sha256, entry in index.get("entries", []):
+            # ページ情報を持たない古い形式のエントリは読み込まない
+            if isinstance(entry, dict) and os.path.exists(self._path(sha256)):
+                self._entries[sha256] = entry
+                self._total_bytes += entry["size"]
+        self._urls = {
+            url: meta for url, meta in index.get("urls", {}).items()
+            if meta.get("sha256") in self._entries
+        }
+
+    def _save(self) -> None:
+        index = {"urls": self._urls, "entries": list(self._entries.items())}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = os.path.join(self.directory, f"{self.INDEX_FILE}.tmp")
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, ensure_ascii=False)
+            os.replace(temp_path, os.path.join(self.directory, self.INDEX_FILE))
+        except OSError:
+            pass
+
+    def validators(self, url: str) -> dict:
+        """
+        条件付きGET用のヘッダ(If-None-Match / If-Modified-Since)を返す
+        """
+        meta = self._urls.get(url)
+        if not meta or meta.get("sha256") not in self:
+            return {}
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def lookup(self, url: str) -> Optional[str]:
+        """
+        URLに紐づくPDFのハッシュを返す(304 Not Modified の場合に使用)
+        """
+        meta = self._urls.get(url)
+        if not meta or meta.get("sha256") not in self._entries:
+            return None
+        return meta["sha256"]
+
+    def __contains__(self, sha256: str) -> bool:
+        # OCRに失敗したページがあるエントリは、解析し直すまで持っていないものとして扱う
+        entry = self._entries.get(sha256)
+        return entry is not None and not entry.get("incomplete")
+
+    def _read(self, sha256: str, start: int, end: int) -> Optional[str]:
+        try:
+            with open(self._path(sha256), "rb") as f:
+                f.seek(start)
+                data = f.read(end - start)
+        except OSError:
+            self._discard(sha256)
+            return None
+        self._entries.move_to_end(sha256)
+        return data.decode("utf-8")
+
+    def get_text(self, sha256: str) -> Optional[str]:
+        """
+        PDF全体のテキストを取得する
+        """
+        entry = self._entries.get(sha256)
+        if entry is None:
+            return None
+        return self._read(sha256, 0, entry["size"])
+
+    def get_pages(self, sha256: str, first: int, last: int) -> Optional[list]:
+        """
+        first〜lastページ(1始まり、両端を含む)のテキストをページごとのリストで取得する
+        """
+        entry = self._entries.get(sha256)
+        if entry is None:
+            return None
+        offsets = entry["offsets"]
+        first = max(first, 1)
+        last = min(last, len(offsets) - 1)
+        if first > last:
+            return []
+        text = self._read(sha256, offsets[first - 1], offsets[last])
+        if text is None:
+            return None
+        pages = text.split(self.PAGE_SEPARATOR)
+        # 末尾の区切り文字の後ろは空要素になるので除く
+        return pages[:last - first + 1]
+
+    def page_count(self, sha256: str) -> int:
+        entry = self._entries.get(sha256)
+        return len(entry["offsets"]) - 1 if entry else 0
+
+    def get_toc(self, sha256: str) -> list:
+        entry = self._entries.get(sha256)
+        if not entry:
+            return []
+        if entry.get("toc_version") != TOC_VERSION:
+            # 古い見出しの判定で作った目次は、保存済みのテキストから作り直す
+            pages = self.get_pages(sha256, 1, len(entry["offsets"]) - 1)
+            if pages is None:
+                return []
+            entry.update({"toc": build_toc(pages), "toc_version": TOC_VERSION})
+            self._save()
+        return entry["toc"]
+
+    def put(
+        self,
+        url: str,
+        sha256: str,
+        pages: Optional[list],
+        etag: Optional[str],
+        last_modified: Optional[str],
+        incomplete: bool = False,
+    ) -> None:
+        """
+        抽出したページごとのテキストを保存し、URLと検証用ヘッダを紐づける
+        (pagesがNoneの場合は既存のエントリにURLだけを紐づける)
+        incompleteはOCRに失敗したページがあることを示す。そのエントリは内容のハッシュが一致しても使い回さず、
+        条件付きGETも行わないため、次に取得したときに解析し直される。
+        """
+        entry = self._entries.get(sha256)
+        if entry is None or (pages is not None and entry.get("incomplete")):
+            if pages is None:
+                return
+            offsets = [0]
+            chunks = []
+            for page in pages:
+                chunk = (page.replace(self.PAGE_SEPARATOR, "") + self.PAGE_SEPARATOR).encode("utf-8")
+                chunks.append(chunk)
+                offsets.append(offsets[-1] + len(chunk))
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self._path(sha256), "wb") as f:
+                    f.write(b"".join(chunks))
+            except OSError:
+                return
+            if entry is not None:
+                self._total_bytes -= entry["size"]
+            self._entries[sha256] = {"size": offsets[-1], "offsets": offsets, "toc": build_toc(pages), "toc_version": TOC_VERSION}
+            if incomplete:
+                self._entries[sha256]["incomplete"] = True
+            self._total_bytes += offsets[-1]
+        self._entries.move_to_end(sha256)
+        self._urls[url] = {"etag": etag, "last_modified": last_modified, "sha256": sha256}
+        self._evict()
+        self._save()
+
+    def _ocr_path(self, sha256: str, page_number: int, variant: str) -> str:
+        return os.path.join(self.directory, "ocr", f"{sha256}-{page_number}-{variant}.txt")
+
+    def get_ocr_page(self, sha256: str, page_number: int, variant: str) -> Optional[str]:
+        """
+        ページ単位のOCR結果を取得する(variantはDPIと言語の組み合わせ)
+        """
+        try:
+            with open(self._ocr_path(sha256, page_number, variant), encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put_ocr_page(self, sha256: str, page_number: int, variant: str, text: str) -> None:
+        try:
+            os.makedirs(os.path.join(self.directory, "ocr"), exist_ok=True)
+            with open(self._ocr_path(sha256, page_number, variant), "w", encoding="utf-8") as f:
+                f.write(text)
+        except OSError:
+            pass
+
+    def _sections_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, "sections", f"{sha256}.json.gz")
+
+    def get_sections(self, sha256: str, version: int) -> Optional[list]:
+        """
+        見出しごとに分割したチャンクを取得する(分割方法のversionが異なる場合はNone)
+        """
+        try:
+            with gzip.open(self._sections_path(sha256), "rt", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return stored["chunks"] if stored.get("version") == version else None
+
+    def put_sections(self, sha256: str, version: int, chunks: list) -> None:
+        if sha256 not in self:
+            return
+        try:
+            os.makedirs(os.path.join(self.directory, "sections"), exist_ok=True)
+            with gzip.open(self._sections_path(sha256), "wt", encoding="utf-8") as f:
+                json.dump({"version": version, "chunks": chunks}, f, ensure_ascii=False, separators=(",", ":"))
+        except OSError:
+            pass
+
+    def _discard(self, sha256: str) -> None:
+        entry = self._entries.pop(sha256, None)
+        if entry is not None:
+            self._total_bytes -= entry["size"]
+        self._urls = {url: meta for url, meta in self._urls.items() if meta.get("sha256") != sha256}
+        try:
+            os.unlink(self._path(sha256))
+        except OSError:
+            pass
+        try:
+            os.unlink(self._sections_path(sha256))
+        except OSError:
+            pass
+        # このPDFのページ単位のOCR結果も削除する
+        ocr_directory = os.path.join(self.directory, "ocr")
+        try:
+            for name in os.listdir(ocr_directory):
+                if name.startswith(f"{sha256}-"):
+                    os.unlink(os.path.join(ocr_directory, name))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        # 最新のエントリは上限を超えていても残す
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            sha256 = next(iter(self._entries))
+            self._discard(sha256)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# 目次として扱う見出し行(「第1章」「1.」「2.3」など)
+# 番号の後ろには「.」か空白が必要で、数字が続く行や、空白の後に単位(「3 分」「10 人」など)が続く行は見出しにしない
+# (「2025年」「3分以内」のように番号に単位が直接続く行は、区切りがないため見出しにならない)
+TOC_HEADING_PATTERN = re.compile(
+    r"^(第[0-9０-９一二三四五六七八九十百]+[章節条部](?=[\s　]*\S)"
+    r"|[0-9０-９]{1,2}(?:[.．][0-9０-９]{1,2}){0,2}"
+    r"(?=(?:[.．][\s　]*(?![0-9０-９])"
+    r"|[\s　]+(?![0-9０-９]|[年月日時分秒人台回点個枚本件名歳%％]|(?:[kcm]?m|kg|g)(?![A-Za-z])))\S))"
+)
+
+# 目次の作り方を変えた場合は上げる(保存済みの目次を作り直す)
+TOC_VERSION = 2
+
+
+def build_toc(pages: list) -> list:
+    """
+    ページごとのテキストから見出し行を拾い、目次(見出しとページ番号)を作る
+    """
+    toc = []
+    for page_number, page in enumerate(pages, start=1):
+        for line in page.splitlines():
+            line = line.strip()
+            if len(line) <= 60 and TOC_HEADING_PATTERN.match(line):
+                toc.append({"title": line, "page": page_number})
+    return toc
+
+
+pdf_text_cache = PdfTextCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES)
+
+
+class PdfQueueFull(Exception):
+    """
+    PDF解析の待ち行列が上限に達した場合の例外
+    """
+
+
+# PDF解析用のプロセスプールと、実行中のジョブ(キー -> (Future, 打ち切る時刻))
+_pdf_executor: Optional[ProcessPoolExecutor] = None
+_pdf_jobs: dict = {}
+
+
+def get_pdf_executor() -> ProcessPoolExecutor:
+    """
+    PDF解析用のプロセスプールを返す(初回呼び出し時に作成する)
+    """
+    global _pdf_executor
+    if _pdf_executor is None:
+        # イベントループのスレッドを引き継がないようにspawnで起動する
+        _pdf_executor = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=pdf_worker.init_worker,
+            initargs=(os.getpid(),),
+        )
+    return _pdf_executor
+
+
+def shutdown_pdf_executor() -> None:
+    """
+    PDF解析用のプロセスプールを停止する
+    """
+    global _pdf_executor
+    if _pdf_executor is not None:
+        _pdf_executor.shutdown(wait=False, cancel_futures=True)
+    _pdf_executor = None
+    _pdf_jobs.clear()
+
+
+def terminate_pdf_executor() -> None:
+    """
+    PDF解析用のワーカーを強制終了し、次のジョブで新しいプロセスプールを作らせる
+    実行中・待機中のジョブはBrokenProcessPoolで失敗する
+    """
+    global _pdf_executor
+    executor = _pdf_executor
+    _pdf_executor = None
+    _pdf_jobs.clear()
+    if executor is None:
+        return
+    kill_workers = getattr(executor, "kill_workers", None)
+    if kill_workers is not None:
+        kill_workers()
+    else:
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.kill()
+    executor.shutdown(wait=False)
+
+
+@contextmanager
+def _without_main_module():
+    """
+    spawnで起動するワーカーがサーバ本体(__main__)を読み込み直さないよう、その間だけ__main__を空のモジュールにする
+    ワーカーで実行する関数はrims_mcp_pdf_workerにあり、MCPの読み込みやキャッシュの初期化はワーカーでは不要なため
+    """
+    main_module = sys.modules["__main__"]
+    sys.modules["__main__"] = ModuleType("__main__")
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main_module
+
+
+def _submit_pdf_job(key: str, func, args: tuple) -> tuple:
+    global _pdf_executor
+    # ワーカーのプロセスは必要に応じてsubmitの中で起動される
+    with _without_main_module():
+        try:
+            future = get_pdf_executor().submit(func, *args)
+        except (BrokenProcessPool, RuntimeError):
+            # ワーカーが異常終了した(または停止済みの)場合はプールを作り直す
+            _pdf_executor = None
+            future = get_pdf_executor().submit(func, *args)
+    entry = (asyncio.wrap_future(future), asyncio.get_running_loop().time() + PDF_JOB_TIMEOUT)
+    _pdf_jobs[key] = entry
+
+    def done(job: asyncio.Future) -> None:
+        if _pdf_jobs.get(key) is entry:
+            del _pdf_jobs[key]
+        # 待機側がいなくなったジョブの例外も取り出しておく(未取得の警告を出さないため)
+        if not job.cancelled():
+            job.exception()
+
+    entry[0].add_done_callback(done)
+    return entry
+
+
+async def run_pdf_job(key: str, func, *args):
+    """
+    funcをプロセスプールで実行して結果を返す
+    同じキーのジョブが実行中であれば、新しく投入せずにその結果を共有する
+    ジョブが投入からPDF_JOB_TIMEOUT秒を超えた場合は、ワーカーを強制終了してasyncio.TimeoutErrorを送出する
+    """
+    for attempt in range(2):
+        entry = _pdf_jobs.get(key)
+        if entry is None:
+            if len(_pdf_jobs) >= PDF_QUEUE_MAX:
+                raise PdfQueueFull()
+            entry = _submit_pdf_job(key, func, args)
+        job, deadline = entry
+        try:
+            return await asyncio.wait_for(asyncio.shield(job), max(deadline - asyncio.get_running_loop().time(), 0))
+        except asyncio.TimeoutError:
+            # 待機を打ち切るだけではワーカーが解析を続けるため、プールごと止めて作り直す
+            if _pdf_jobs.get(key) is entry:
+                logger.warning("PDF job %s timed out after %s seconds; restarting workers", key, PDF_JOB_TIMEOUT)
+                terminate_pdf_executor()
+            raise
+        except BrokenProcessPool:
+            # 他のジョブのタイムアウトやワーカーの異常終了に巻き込まれた場合は、1回だけ投入し直す
+            if attempt:
+                raise
+            if _pdf_jobs.get(key) is entry:
+                _pdf_jobs.pop(key, None)
+
+
+def start_resource_tracker() -> None:
+    """
+    multiprocessingのリソーストラッカーを、標準出力をstderrに向けた状態で起動する
+    (stdioトランスポートのパイプをトラッカーが保持し続けないようにする)
+    """
+    saved_stdout = os.dup(1)
+    try:
+        os.dup2(2, 1)
+        resource_tracker.ensure_running()
+    finally:
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+
+
+class PdfTooLarge(Exception):
+    """
+    PDFのサイズがPDF_MAX_BYTESを超えた場合の例外
+    """
+
+
+async def download_pdf(url: str, headers: dict) -> dict:
+    """
+    PDFを分割して受信し、受信しながらSHA-256を計算する
+    サイズがPDF_MAX_BYTESを超えた時点で受信を打ち切る
+    """
+    started = time.perf_counter()
+
+    async def attempt(session: aiohttp.ClientSession) -> tuple:
+        async with session.get(url, headers=headers) as response:
+            metrics.inc("upstream_responses_total", (("endpoint", "pdf"), ("status", response.status)))
+            result = {
+                "status": response.status,
+                "data": None,
+                "sha256": None,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            if response.status != 200:
+                return response.status, result
+            if response.content_length is not None and response.content_length > PDF_MAX_BYTES:
+                raise PdfTooLarge(f"PDF is too large ({response.content_length} bytes, limit {PDF_MAX_BYTES} bytes).")
+
+            data = bytearray()
+            digest = hashlib.sha256()
+            async for chunk in response.content.iter_chunked(PDF_CHUNK_SIZE):
+                if len(data) + len(chunk) > PDF_MAX_BYTES:
+                    raise PdfTooLarge(f"PDF exceeds the size limit of {PDF_MAX_BYTES} bytes.")
+                data.extend(chunk)
+                digest.update(chunk)
+        result["data"] = data
+        result["sha256"] = digest.hexdigest()
+        return response.status, result
+
+    _, result = await upstream_get(url, attempt)
+    if result["data"] is not None:
+        elapsed = time.perf_counter() - started
+        record_pdf_metrics(url, bytes_transferred=len(result["data"]), download_ms=round(elapsed * 1000, 1))
+        metrics.inc("upstream_bytes_total", (("endpoint", "pdf"),), len(result["data"]))
+        metrics.observe("upstream_latency", (("endpoint", "pdf"),), elapsed, status=200, bytes=len(result["data"]))
+    return result
+
+
+# PDFごとの計測値(URL -> 計測値)。直近PDF_METRICS_MAX件まで保持する
+pdf_metrics: OrderedDict = OrderedDict()
+PDF_METRICS_MAX = 64
+
+
+def record_pdf_metrics(url: str, **values) -> None:
+    entry = pdf_metrics.pop(url, {})
+    entry.update(values)
+    pdf_metrics[url] = entry
+    while len(pdf_metrics) > PDF_METRICS_MAX:
+        pdf_metrics.popitem(last=False)
+
+
+# 取得・解析中のPDF(URL -> タスク)
+_pdf_loads: dict = {}
+# PDFを最後に確認した時刻(URL -> time.monotonic())
+_pdf_checked_at: dict = {}
+
+
+async def load_pdf(url: str) -> Union[str, dict]:
+    """
+    PDFを取得してページごとのテキストをキャッシュに載せ、PDFのハッシュを返す
+    同じURLの取得・解析が実行中であれば、その結果を共有する
+    PDF_REVALIDATE_INTERVAL秒以内に確認したPDFは、条件付きGETも行わずにキャッシュを使う
+    """
+    checked_at = _pdf_checked_at.get(url)
+    if checked_at is not None and time.monotonic() - checked_at < PDF_REVALIDATE_INTERVAL:
+        sha256 = pdf_text_cache.lookup(url)
+        if sha256 is not None:
+            pdf_text_cache.hits += 1
+            return sha256
+
+    task = _pdf_loads.get(url)
+    if task is None:
+        task = asyncio.create_task(_load_pdf(url))
+        _pdf_loads[url] = task
+        task.add_done_callback(lambda _: _pdf_loads.pop(url, None))
+    sha256 = await asyncio.shield(task)
+    if isinstance(sha256, str):
+        _pdf_checked_at[url] = time.monotonic()
+    return sha256
+
+
+async def _load_pdf(url: str) -> Union[str, dict]:
+    """
+    PDFを取得してページごとのテキストをキャッシュに載せ、PDFのハッシュを返す
+    2回目以降は条件付きGETで更新の有無だけを確認する
+    """
+    headers = {"Referer": WEB_PAGE_URL}
+    headers.update(pdf_text_cache.validators(url))
+
+    try:
+        download = await download_pdf(url, headers)
+        if download["status"] == 304:
+            sha256 = pdf_text_cache.lookup(url)
+            if sha256 is not None:
+                pdf_text_cache.hits += 1
+                pdf_text_cache.revalidated += 1
+                record_pdf_metrics(url, bytes_transferred=0)
+                return sha256
+            # キャッシュが消えていた場合は条件なしで取得し直す
+            download = await download_pdf(url, {"Referer": WEB_PAGE_URL})
+        if download["status"] != 200:
+            if download["status"] >= 500 or download["status"] == 429:
+                return cached_pdf_or_error(url, f"Failed to fetch PDF. Status code: {download['status']}")
+            return {"error": f"Failed to fetch PDF. Status code: {download['status']}"}
+
+    except PdfTooLarge as e:
+        return {"error": str(e)}
+    except UpstreamUnavailable as e:
+        return cached_pdf_or_error(url, str(e))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        metrics.inc("upstream_responses_total", (("endpoint", "pdf"), ("status", "error")))
+        return cached_pdf_or_error(url, f"HTTP request failed: {str(e)}")
+
+    data = download["data"]
+    sha256 = download["sha256"]
+    etag = download["etag"]
+    last_modified = download["last_modified"]
+
+    # URLが変わっても内容が同じであればキャッシュを使う
+    if sha256 in pdf_text_cache:
+        pdf_text_cache.hits += 1
+        pdf_text_cache.put(url, sha256, None, etag, last_modified)
+        return sha256
+    pdf_text_cache.misses += 1
+
+    # PDFの解析はプロセスプールで実行し、イベントループを止めない
+    started = time.perf_counter()
+    try:
+        pages, parse_rss_kb = await run_pdf_job(sha256, pdf_worker.extract_pdf_pages, data)
+    except PdfQueueFull:
+        return {"error": "PDF extraction queue is full. Please retry later."}
+    except asyncio.TimeoutError:
+        return {"error": f"PDF text extraction timed out after {PDF_JOB_TIMEOUT} seconds."}
+    except Exception as e:
+        return {"error": f"PDF text extraction failed: {str(e)}"}
+
+    # テキストレイヤーのないページ(スキャン画像など)だけOCRする
+    ocr_pages = [page_number for page_number, text in enumerate(pages, start=1) if not text.strip()]
+    ocr_failed = []
+    if ocr_pages and ocr_available():
+        pages, ocr_failed = await ocr_pdf_pages(sha256, data, pages, ocr_pages)
+    else:
+        ocr_pages = []
+
+    elapsed = time.perf_counter() - started
+    record_pdf_metrics(
+        url,
+        buffer_bytes=len(data),
+        parse_ms=round(elapsed * 1000, 1),
+        pages=len(pages),
+        ocr_pages=len(ocr_pages),
+        ocr_failed_pages=len(ocr_failed),
+        parse_rss_kb=parse_rss_kb,
+    )
+    metrics.observe("pdf_parse", (), elapsed, pages=len(pages), ocr_pages=len(ocr_pages))
+    metrics.inc("pdf_pages_total", (), len(pages))
+    metrics.inc("pdf_ocr_pages_total", (), len(ocr_pages))
+    logger.info("Parsed PDF %s: %s", url, pdf_metrics[url])
+    pdf_text_cache.put(url, sha256, pages, etag, last_modified, incomplete=bool(ocr_failed))
+    return sha256
+
+
+def cached_pdf_or_error(url: str, error: str) -> Union[str, dict]:
+    """
+    上流APIが使えない場合に、以前取得したPDFのテキストがあればそのハッシュを返す
+    """
+    sha256 = pdf_text_cache.lookup(url)
+    if sha256 is not None:
+        logger.warning("Serving cached PDF text for %s: %s", url, error)
+        pdf_text_cache.hits += 1
+        return sha256
+    return {"error": error}
+
+
+def ocr_available() -> bool:
+    """
+    OCRが有効で、pdftoppm(poppler-utils)とtesseractが使える場合にTrueを返す
+    """
+    global _ocr_available
+    if _ocr_available is None:
+        _ocr_available = OCR_ENABLED and all(shutil.which(command) for command in ("pdftoppm", "tesseract"))
+        if OCR_ENABLED and not _ocr_available:
+            logger.warning("OCR is disabled because pdftoppm or tesseract is not installed.")
+    return _ocr_available
+
+
+_ocr_available: Optional[bool] = None
+
+
+async def ocr_pdf_pages(sha256: str, data: bytearray, pages: list, page_numbers: list) -> tuple:
+    """
+    指定したページをOCRし、(その結果で置き換えたページのリスト, OCRに失敗したページ番号のリスト)を返す
+    ページごとにプロセスプールへ投入して並列に処理し、結果はページ単位でキャッシュする
+    """
+    variant = f"{OCR_DPI}-{OCR_LANG}"
+    pages = list(pages)
+    missing = []
+    for page_number in page_numbers:
+        cached_text = pdf_text_cache.get_ocr_page(sha256, page_number, variant)
+        if cached_text is not None:
+            pages[page_number - 1] = cached_text
+        else:
+            missing.append(page_number)
+    if not missing:
+        return pages, []
+
+    # ラスタライズ用にPDFを一度だけ書き出し、各ワーカーはそのファイルを読む
+    pdf_path = await asyncio.to_thread(_write_temp_pdf, data)
+    failed = []
+
+    # 1つのPDFでキューを使い切らないように、同時に投入するページ数はワーカー数までにする
+    semaphore = asyncio.Semaphore(PDF_WORKERS)
+
+    async def ocr_page(page_number: int) -> None:
+        async with semaphore:
+            try:
+                text = await run_pdf_job(
+                    f"{sha256}:ocr:{page_number}:{variant}", pdf_worker.ocr_pdf_page, pdf_path, page_number, OCR_DPI, OCR_LANG
+                )
+            except Exception as e:
+                logger.warning("OCR of page %s failed: %s", page_number, e)
+                failed.append(page_number)
+                return
+        pages[page_number - 1] = text
+        pdf_text_cache.put_ocr_page(sha256, page_number, variant, text)
+
+    try:
+        await asyncio.gather(*(ocr_page(page_number) for page_number in missing))
+    finally:
+        os.unlink(pdf_path)
+    return pages, sorted(failed)
+
+
+def _write_temp_pdf(data: bytearray) -> str:
+    """
+    PDFを一時ファイルに書き出してパスを返す(スレッドで実行される)
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
+        temp_file.write(data)
+        return temp_file.name
+
+
+# PDFのURLを受け取り、OCRを実行してテキストを返すツール
+async def pdf_ocr(url: str) -> Union[str, dict]:
+    """
+    PDFのURLを受け取り、OCRを実行してテキストを返すツール
+    """
+    sha256 = await load_pdf(url)
+    if isinstance(sha256, dict):
+        return sha256
+    text = pdf_text_cache.get_text(sha256)
+    if text is None:
+        return {"error": "PDF text is no longer cached. Please retry."}
+    return text
+
+
+async def pdf_pages(url: str, first: int, last: int) -> dict:
+    """
+    PDFのfirst〜lastページ(1始まり、両端を含む)のテキストと、ページ数・目次を返す
+    """
+    sha256 = await load_pdf(url)
+    if isinstance(sha256, dict):
+        return sha256
+    pages = pdf_text_cache.get_pages(sha256, first, last)
+    if pages is None:
+        return {"error": "PDF text is no longer cached. Please retry."}
+    return {
+        "page_count": pdf_text_cache.page_count(sha256),
+        "toc": pdf_text_cache.get_toc(sha256),
+        "pages": [
+            {"page": page_number, "text": text}
+            for page_number, text in enumerate(pages, start=max(first, 1))
+        ],
+    }
+
+# 文の区切り(句点などの後ろ、または空行)
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[。．！？!?])|(?<=\.)\s+|\n\s*\n")
+
+
+def split_sections(pages: list) -> list:
+    """
+    ページごとのテキストを見出し行で節に分け、節ごとに文のリストにする
+    PDFの改行位置は版によって変わるため、節内の行は連結してから文に分割する。
+    """
+    sections = [{"title": "", "page": 1, "lines": []}]
+    for page_number, page in enumerate(pages, start=1):
+        for line in page.splitlines():
+            line = " ".join(line.split())
+            if not line:
+                continue
+            if len(line) <= 60 and TOC_HEADING_PATTERN.match(line):
+                sections.append({"title": line, "page": page_number, "lines": []})
+            else:
+                sections[-1]["lines"].append(line)
+    for section in sections:
+        text = " ".join(section.pop("lines"))
+        section["sentences"] = [
+            sentence.strip() for sentence in SENTENCE_SPLIT_PATTERN.split(text) if sentence and sentence.strip()
+        ]
+    return [section for section in sections if section["title"] or section["sentences"]]
+
+
+def _section_key(title: str) -> str:
+    """
+    版の間で節を対応付けるためのキー(見出しの番号、番号がなければ見出し全体)
+    """
+    number = _heading_number(title)
+    return title if number is None else number
+
+
+def diff_sections(old_sections: list, new_sections: list) -> list:
+    """
+    節ごとに文単位の差分をとり、変更のあった節だけを返す
+    節はまず見出しが同じもの同士、次に見出しの番号が同じもの同士を、それぞれ出現順に対応付ける。
+    """
+    paired = [None] * len(new_sections)
+    unmatched_old = set(range(len(old_sections)))
+    for key_of in (lambda section: section["title"], lambda section: _section_key(section["title"])):
+        candidates = {}
+        for index in sorted(unmatched_old):
+            candidates.setdefault(key_of(old_sections[index]), deque()).append(index)
+        for new_index, section in enumerate(new_sections):
+            if paired[new_index] is None and candidates.get(key_of(section)):
+                paired[new_index] = candidates[key_of(section)].popleft()
+                unmatched_old.discard(paired[new_index])
+
+    changes = []
+    for section, old_index in zip(new_sections, paired):
+        if old_index is None:
+            changes.append({"section": section["title"], "type": "added", "new_page": section["page"], "added": section["sentences"]})
+            continue
+        old_section = old_sections[old_index]
+
+        edits = []
+        matcher = difflib.SequenceMatcher(None, old_section["sentences"], section["sentences"], autojunk=False)
+        for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+            edit = {"op": tag}
+            if old_end > old_start:
+                edit["old"] = old_section["sentences"][old_start:old_end]
+            if new_end > new_start:
+                edit["new"] = section["sentences"][new_start:new_end]
+            edits.append(edit)
+        if edits or old_section["title"] != section["title"]:
+            change = {"section": section["title"], "type": "changed", "old_page": old_section["page"], "new_page": section["page"]}
+            if old_section["title"] != section["title"]:
+                change["old_section"] = old_section["title"]
+            change["edits"] = edits
+            changes.append(change)
+
+    for index in sorted(unmatched_old):
+        section = old_sections[index]
+        changes.append({"section": section["title"], "type": "removed", "old_page": section["page"], "removed": section["sentences"]})
+    return changes
+
+
+# ルールブックの差分((旧版のハッシュ, 新版のハッシュ) -> 差分)
+rule_diffs: OrderedDict = OrderedDict()
+RULE_DIFFS_MAX = 16
+
+
+async def rule_book_diff(old_url: str, new_url: str) -> dict:
+    """
+    2つのPDFのテキスト(キャッシュ済み)から節ごとの差分を作る
+    差分は内容のハッシュの組をキーにしてキャッシュし、同じ版の比較は再計算しない。
+    """
+    old_sha256, new_sha256 = await asyncio.gather(load_pdf(old_url), load_pdf(new_url))
+    for sha256 in (old_sha256, new_sha256):
+        if isinstance(sha256, dict):
+            return sha256
+
+    key = (old_sha256, new_sha256)
+    if key in rule_diffs:
+        rule_diffs.move_to_end(key)
+        return rule_diffs[key]
+
+    old_pages = pdf_text_cache.get_pages(old_sha256, 1, pdf_text_cache.page_count(old_sha256))
+    new_pages = pdf_text_cache.get_pages(new_sha256, 1, pdf_text_cache.page_count(new_sha256))
+    if old_pages is None or new_pages is None:
+        return {"error": "PDF text is no longer cached. Please retry."}
+
+    changes = diff_sections(split_sections(old_pages), split_sections(new_pages))
+    result = {
+        "identical": old_sha256 == new_sha256 or not changes,
+        "changed_sections": len(changes),
+        "changes": changes,
+    }
+    if old_sha256 not in pdf_text_cache or new_sha256 not in pdf_text_cache:
+        # OCRに失敗したページがある版の差分は、解析し直した後に作り直す
+        return result
+    rule_diffs[key] = result
+    while len(rule_diffs) > RULE_DIFFS_MAX:
+        rule_diffs.popitem(last=False)
+    return result
+
+# 検索用のトークン(英数字の単語、またはそれ以外の文字の連続)
+SEARCH_TOKEN_PATTERN = re.compile(r"[0-9a-z]+|[^\W0-9a-z_]+")
+
+
+def tokenize(text: str, for_query: bool = False) -> list:
+    """
+    全文検索用にテキストをトークンに分割する
+    英数字は単語単位、日本語などの文字列は2文字ずつのn-gramにする。
+    文書側は1文字のn-gramも持たせ、1文字だけのクエリでも検索できるようにする。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for match in SEARCH_TOKEN_PATTERN.finditer(text):
+        word = match.group()
+        if word.isascii():
+            tokens.append(word)
+            continue
+        bigrams = [word[i:i + 2] for i in range(len(word) - 1)]
+        if for_query:
+            tokens.extend(bigrams or [word])
+        else:
+            tokens.extend(bigrams)
+            tokens.extend(word)
+    return tokens
+
+
+class SearchIndex:
+    """
+    BM25でランキングする転置インデックス
+    文書はIDごとに追加・置換・削除でき、内容が変わっていない文書は再インデックスしない。
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # トークン -> {文書ID: 出現回数}
+        self._postings: dict = {}
+        # 文書ID -> {"digest", "length", "terms", "text", "payload"}
+        self._docs: dict = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._docs
+
+    def ids(self, prefix: str = "") -> set:
+        return {doc_id for doc_id in self._docs if doc_id.startswith(prefix)}
+
+    def add(self, doc_id: str, text: str, payload: dict) -> bool:
+        """
+        文書を追加する(内容が変わっていればインデックスし直す)。インデックスを更新した場合はTrueを返す
+        """
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        existing = self._docs.get(doc_id)
+        if existing is not None and existing["digest"] == digest:
+            existing["payload"] = payload
+            return False
+        if existing is not None:
+            self.remove(doc_id)
+
+        terms = {}
+        for token in tokenize(text):
+            terms[token] = terms.get(token, 0) + 1
+        for token, count in terms.items():
+            self._postings.setdefault(token, {})[doc_id] = count
+        length = sum(terms.values())
+        self._docs[doc_id] = {"digest": digest, "length": length, "terms": list(terms), "text": text, "payload": payload}
+        self._total_length += length
+        return True
+
+    def remove(self, doc_id: str) -> None:
+        doc = self._docs.pop(doc_id, None)
+        if doc is None:
+            return
+        for token in doc["terms"]:
+            posting = self._postings.get(token)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self._postings[token]
+        self._total_length -= doc["length"]
+
+    def search(self, query: str, top_k: int = 10, prefixes: Optional[list] = None, full_text: bool = False) -> list:
+        """
+        クエリに一致する文書をスコアの高い順に返す。prefixesを指定した場合はIDがいずれかで始まる文書に限定する
+        full_textがTrueの場合は抜粋ではなく文書の全文を"text"として返す
+        """
+        if not self._docs:
+            return []
+        doc_count = len(self._docs)
+        average_length = self._total_length / doc_count or 1
+        scores: dict = {}
+        for token in set(tokenize(query, for_query=True)):
+            posting = self._postings.get(token)
+            if not posting:
+                continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, count in posting.items():
+                length = self._docs[doc_id]["length"]
+                score = idf * count * (self.k1 + 1) / (count + self.k1 * (1 - self.b + self.b * length / average_length))
+                scores[doc_id] = scores.get(doc_id, 0.0) + score
+
+        if prefixes:
+            scores = {doc_id: score for doc_id, score in scores.items() if doc_id.startswith(tuple(prefixes))}
+        ranked = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        if full_text:
+            return [
+                {**self._docs[doc_id]["payload"], "score": round(score, 4), "text": self._docs[doc_id]["text"]}
+                for doc_id, score in ranked
+            ]
+        return [
+            {
+                **self._docs[doc_id]["payload"],
+                "score": round(score, 4),
+                "snippet": make_snippet(self._docs[doc_id]["text"], query),
+            }
+            for doc_id, score in ranked
+        ]
+
+
+def make_snippet(text: str, query: str, width: int = 80) -> str:
+    """
+    クエリの語が最初に現れる位置の前後を抜き出す
+    """
+    normalized = unicodedata.normalize("NFKC", text)
+    lowered = normalized.lower()
+    positions = [
+        lowered.find(word)
+        for word in unicodedata.normalize("NFKC", query).lower().split()
+        if word
+    ]
+    positions = [position for position in positions if position >= 0]
+    start = max(min(positions) - width // 4, 0) if positions else 0
+    return " ".join(normalized[start:start + width].split())
+
+
+class IndexRefresher:
+    """
+    検索インデックスの更新を管理する
+    refreshはインデックスを更新し、使える状態になった場合にTrueを返す非同期関数。
+    同時に更新を求められた場合は実行中の更新を共有し、最後に更新できた時刻を持つ。
+    """
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self.updated_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        if await self.refresh():
+            self.updated_at = time.monotonic()
+
+    def start(self) -> asyncio.Task:
+        """
+        更新を裏で開始する(更新中であれば実行中のタスクを返す)
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def ensure(self) -> bool:
+        """
+        初回は更新を待ち、SEARCH_INDEX_TTL秒より古ければ裏で更新を始める
+        インデックスが使える状態であればTrueを返す
+        """
+        if self.updated_at is None:
+            await asyncio.shield(self.start())
+            return self.updated_at is not None
+        if time.monotonic() - self.updated_at > SEARCH_INDEX_TTL:
+            # 古くなったインデックスは裏で更新し、今回は手元のインデックスで答える
+            self.start()
+        return True
+
+    def age(self) -> float:
+        return round(time.monotonic() - self.updated_at, 1)
+
+
+# FAQ・ニュース・ルールブックの全文検索インデックス
+search_index = SearchIndex()
+
+
+async def refresh_search_index() -> bool:
+    """
+    FAQ・ニュース・ルールブックを取得して検索インデックスを更新する
+    取得済みのニュース記事は取得し直さず、内容が変わった文書だけをインデックスし直す。
+    どの取得にも失敗した場合はFalseを返し、インデックスを更新済みとしない(次の呼び出しで再び取得する)。
+    """
+    loaded = False
+    # FAQ
+    status, data, cache_age = await fetch_json(f"{API_ENDPOINT}/api/v2/web/competition/get_faq.php?id={COMPETITION_ID}&query=", CACHE_TTL_FAQ)
+    if data is not None:
+        loaded = True
+        seen = set()
+        for item in data.get("answered", []):
+            doc_id = f"faq:{item.get('number')}"
+            seen.add(doc_id)
+            search_index.add(
+                doc_id,
+                f"{item.get('question', '')}\n{item.get('answer', '')}",
+                {
+                    "source": "faq",
+                    "number": item.get("number"),
+                    "question": item.get("question", ""),
+                    "answer": item.get("answer", ""),
+                },
+            )
+        for doc_id in search_index.ids("faq:") - seen:
+            search_index.remove(doc_id)
+
+    # ニュース(新しく現れた記事だけ本文を取得する)
+    status, data, cache_age = await fetch_json(f"{API_ENDPOINT}/api/v2/web/competition/get_news.php?id={COMPETITION_ID}", CACHE_TTL_NEWS)
+    if data is not None:
+        loaded = True
+        news = data.get("news", [])
+        article_ids = {str(item.get("article_id", item.get("id"))) for item in news}
+        for doc_id in search_index.ids("news:") - {f"news:{article_id}" for article_id in article_ids}:
+            search_index.remove(doc_id)
+        semaphore = asyncio.Semaphore(NEWS_BATCH_CONCURRENCY)
+
+        async def index_article(item: dict) -> None:
+            article_id = str(item.get("article_id", item.get("id")))
+            if f"news:{article_id}" in search_index:
+                return
+            async with semaphore:
+                result = await fetch_news_article(article_id)
+            if "error" in result:
+                return
+            article = result["news"]
+            text = f"{article['title']}\n{article['content']}"
+            if isinstance(article["ocr_text"], str):
+                text = f"{text}\n{article['ocr_text']}"
+            search_index.add(
+                f"news:{article_id}",
+                text,
+                {
+                    "source": "news",
+                    "article_id": article_id,
+                    "title": article["title"] or item.get("title", ""),
+                    "date": article["date"] or item.get("date", ""),
+                },
+            )
+
+        await asyncio.gather(*(index_article(item) for item in news))
+
+    # ルールブック(最新版のページ単位)
+    status, data, cache_age = await fetch_json(RULES_URL, CACHE_TTL_RULES)
+    if data is not None:
+        rule_book = latest_rule_book(data.get("rules", {}))
+        if rule_book and rule_book.get("url"):
+            sha256 = await load_pdf(rule_book["url"])
+            if isinstance(sha256, str):
+                loaded = True
+                page_count = pdf_text_cache.page_count(sha256)
+                pages = pdf_text_cache.get_pages(sha256, 1, page_count) or []
+                for doc_id in search_index.ids("rules:") - {f"rules:{n}" for n in range(1, len(pages) + 1)}:
+                    search_index.remove(doc_id)
+                for page_number, text in enumerate(pages, start=1):
+                    search_index.add(
+                        f"rules:{page_number}",
+                        text,
+                        {"source": "rules", "page": page_number, "date": rule_book.get("date", "")},
+                    )
+
+    return loaded
+
+
+search_index_refresher = IndexRefresher(refresh_search_index)
+
+
+# チャンクの分割方法を変えた場合は上げる(保存済みのチャンクを作り直す)
+SECTION_CHUNK_VERSION = 2
+
+
+def chunk_document(pages: list, max_chars: int) -> list:
+    """
+    ページごとのテキストを見出し行で区切り、max_chars文字程度のチャンクに分割する
+    各チャンクは[見出し, 開始ページ, 終了ページ, 本文]のリスト(保存時に小さくするため)。
+    見出しの下の本文が長い場合は、行の区切りで分けて同じ見出しを付ける。
+    """
+    chunks = []
+    heading = ""
+    lines: list = []
+    size = 0
+    page_start = 1
+    page_end = 1
+
+    def flush() -> None:
+        if lines:
+            chunks.append([heading, page_start, page_end, "\n".join(lines)])
+
+    for page_number, page in enumerate(pages, start=1):
+        for line in page.splitlines():
+            line = " ".join(line.split())
+            if not line:
+                continue
+            is_heading = len(line) <= 60 and TOC_HEADING_PATTERN.match(line)
+            if is_heading or (lines and size + len(line) > max_chars):
+                flush()
+                if is_heading:
+                    heading = line
+                lines, size, page_start = [], 0, page_number
+            lines.append(line)
+            size += len(line)
+            page_end = page_number
+    flush()
+    return chunks
+
+
+# ルールブック・フィールドブック・その他の資料のチャンクの検索インデックス
+section_index = SearchIndex()
+
+
+def rule_documents(rules: dict) -> list:
+    """
+    get_rule.phpのレスポンスから、検索対象の資料((種類, 資料の情報)のリスト)を取り出す
+    ルールブックは最新版のみを対象にする。
+    """
+    documents = []
+    rule_book = latest_rule_book(rules)
+    if rule_book:
+        documents.append(("rule_book", rule_book))
+    documents += [("field_book", item) for item in rules.get("field_books", [])]
+    documents += [("other_document", item) for item in rules.get("other_documents", [])]
+    return [(kind, item) for kind, item in documents if isinstance(item, dict) and item.get("url")]
+
+
+async def refresh_section_index() -> bool:
+    """
+    資料のPDFを見出しごとのチャンクに分割し、検索インデックスを更新する
+    チャンクはPDFのハッシュごとにキャッシュ先へ保存し、内容が変わらない限り作り直さない。
+    ルール情報を取得できなかった場合、またはどの資料も読み込めなかった場合はFalseを返す。
+    """
+    status, data, cache_age = await fetch_json(RULES_URL, CACHE_TTL_RULES)
+    if data is None:
+        return False
+    semaphore = asyncio.Semaphore(PDF_WORKERS)
+
+    async def load(kind: str, item: dict) -> Optional[tuple]:
+        async with semaphore:
+            sha256 = await load_pdf(item["url"])
+        if not isinstance(sha256, str):
+            logger.warning("Skipping %s for section index: %s", item["url"], sha256.get("error"))
+            return None
+        chunks = pdf_text_cache.get_sections(sha256, SECTION_CHUNK_VERSION)
+        if chunks is None:
+            pages = pdf_text_cache.get_pages(sha256, 1, pdf_text_cache.page_count(sha256)) or []
+            chunks = chunk_document(pages, SECTION_CHUNK_CHARS)
+            pdf_text_cache.put_sections(sha256, SECTION_CHUNK_VERSION, chunks)
+        return kind, item, sha256, chunks
+
+    documents = rule_documents(data.get("rules", {}))
+    loaded = await asyncio.gather(*(load(kind, item) for kind, item in documents))
+    doc_ids = set()
+    for kind, item, sha256, chunks in filter(None, loaded):
+        name = item.get("name") or item.get("title") or os.path.basename(item["url"].split("?", 1)[0])
+        for number, (heading, page_start, page_end, text) in enumerate(chunks):
+            doc_id = f"{sha256}:{number}"
+            doc_ids.add(doc_id)
+            section_index.add(
+                doc_id,
+                f"{heading}\n{text}" if heading and not text.startswith(heading) else text,
+                {
+                    "document": name,
+                    "kind": kind,
+                    "date": item.get("date", ""),
+                    "url": item["url"],
+                    "heading": heading,
+                    "page_start": page_start,
+                    "page_end": page_end,
+                },
+            )
+    for doc_id in section_index.ids() - doc_ids:
+        section_index.remove(doc_id)
+    return any(loaded) or not documents
+
+
+section_index_refresher = IndexRefresher(refresh_section_index)
+
+
+# 先読みで最後に確認したルールブックの日付
+_prefetched_rule_book_date: Optional[str] = None
+
+
+async def prefetch_rules() -> None:
+    """
+    ルール情報を取得し直し、最新のルールブックを解析してキャッシュに載せる
+    """
+    global _prefetched_rule_book_date
+    status, data, cache_age = await fetch_json(RULES_URL, 0)
+    if data is None:
+        logger.warning("Prefetch of rules failed. Status code: %s", status)
+        return
+    rule_book = latest_rule_book(data.get("rules", {}))
+    if not rule_book or not rule_book.get("url"):
+        return
+    if rule_book.get("date") != _prefetched_rule_book_date:
+        logger.info("Prefetching rule book dated %s", rule_book.get("date"))
+    # 解析済みであれば条件付きGETで更新の有無を確認するだけで終わる
+    result = await load_pdf(rule_book["url"])
+    if isinstance(result, dict):
+        logger.warning("Prefetch of rule book failed: %s", result["error"])
+        return
+    _prefetched_rule_book_date = rule_book.get("date")
+
+
+async def prefetch_once() -> None:
+    """
+    ルールブック・FAQ・ニュース一覧・チーム一覧を取得し直してキャッシュを温める
+    """
+    semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+    async def run(coro) -> None:
+        async with semaphore:
+            try:
+                await coro
+            except Exception:
+                logger.exception("Prefetch failed")
+
+    await asyncio.gather(
+        run(prefetch_rules()),
+        run(fetch_json(f"{API_ENDPOINT}/api/v2/web/competition/get_faq.php?id={COMPETITION_ID}&query=", 0)),
+        run(fetch_json(f"{API_ENDPOINT}/api/v2/web/competition/get_news.php?id={COMPETITION_ID}", 0)),
+        run(refresh_team_store(0)),
+    )
+    # 検索インデックスは既定では初回のsearch / get_rule_sectionsで作る
+    if PREFETCH_SEARCH_INDEX:
+        await run(search_index_refresher.start())
+    if PREFETCH_SECTION_INDEX:
+        await run(section_index_refresher.start())
+
+
+async def prefetch_loop() -> None:
+    """
+    起動からPREFETCH_DELAY秒後に先読みを行い、以降はPREFETCH_INTERVAL秒ごとに更新する
+    (起動直後のinitialize/list_toolsの応答と、PDFワーカーの起動などでCPUを取り合わないように少し待つ)
+    """
+    await asyncio.sleep(PREFETCH_DELAY)
+    while True:
+        await prefetch_once()
+        await asyncio.sleep(PREFETCH_INTERVAL)
+
+
+async def run_http(transport: str) -> None:
+    """
+    HTTP(SSEまたはStreamable HTTP)で待ち受け、複数のクライアントでキャッシュや接続プールを共有する
+    接続がない間も共有リソースを保持するため、サーバ全体でlifespanを1つ使用しておく。
+    SIGINT/SIGTERMを受けると新しい接続の受け付けを止め、実行中の呼び出しを待ってから終了する。
+    """
+    import uvicorn
+
+    app = mcp.sse_app() if transport == "sse" else mcp.streamable_http_app()
+    config = uvicorn.Config(
+        app,
+        host=MCP_HOST,
+        port=MCP_PORT,
+        log_level=mcp.settings.log_level.lower(),
+        timeout_graceful_shutdown=MCP_SHUTDOWN_TIMEOUT,
+    )
+    async with lifespan(mcp):
+        await uvicorn.Server(config).serve()
 
-    except Exception as e:
-        return {"error": f"Temporary file operation failed: {str(e)}"}
 
 if __name__ == "__main__":
-    # json-rpc ではなく stdio を使用する
-    mcp.run(transport="stdio")
\ No newline at end of file
+    if MCP_TRANSPORT == "stdio":
+        # json-rpc ではなく stdio を使用する
+        mcp.run(transport="stdio")
+    elif MCP_TRANSPORT in ("sse", "streamable-http"):
+        asyncio.run(run_http(MCP_TRANSPORT))
+    else:
+        raise ValueError(f"Unknown MCP_TRANSPORT: {MCP_TRANSPORT}")
\ No newline at end of file